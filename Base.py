@@ -1,18 +1,13 @@
 import streamlit as st
 import pandas as pd
-import uuid
-import os
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-import base64
-from email.mime.text import MIMEText
-from twilio.rest import Client
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from dotenv import load_dotenv
-import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor, execute_values
+from db import contains_pattern, get_pool
+from notifications import Notification, NotificationDispatcher, TokenBucket
+from messaging_clients import GMAIL_SEND_RATE, build_raw_message, get_credential_manager, get_gmail_service, \
+    get_twilio_client, send_gmail_batch
 
 # Load environment variables from Streamlit secrets
 DB_HOST = st.secrets['DB_HOST']
@@ -22,24 +17,18 @@ DB_PASSWORD = st.secrets['DB_PASSWORD']
 TWILIO_ACCOUNT_SID = st.secrets['TWILIO_ACCOUNT_SID']
 TWILIO_AUTH_TOKEN = st.secrets['TWILIO_AUTH_TOKEN']
 
-# Gmail API setup
-SCOPES = ['https://www.googleapis.com/auth/gmail.send']
-
-# Twilio setup
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-
-# PostgreSQL connection
-def get_db_connection():
-    return psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-
 # Set page config for wide layout
 st.set_page_config(page_title="CRM", layout="wide")
 
+# PostgreSQL connection pool, shared across sessions
+db_pool = get_pool(DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)
+
+# Only the columns the portal renders or needs to raise tickets
+USER_COLUMNS = ["id", "first_name", "last_name", "email", "phone_number", "ticket_type"]
+PAGE_SIZES = [25, 50, 100]
+# Seconds before cached user reads go back to the database
+USER_CACHE_TTL = 60
+
 # CSS styling
 st.markdown("""
 <style>
@@ -51,42 +40,19 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
-def get_gmail_service():
+def get_gmail_client_config():
     # Load secrets from Streamlit
     secrets = st.secrets["credentials"]
-    
-    client_id = secrets["installed.client_id"]
-    client_secret = secrets["installed.client_secret"]
-    auth_uri = secrets["installed.auth_uri"]
-    token_uri = secrets["installed.token_uri"]
-    auth_provider_x509_cert_url = secrets["installed.auth_provider_x509_cert_url"]
-    redirect_uris = secrets["installed.redirect_uris"]
-
-    # Create the flow object
-    flow = InstalledAppFlow.from_client_config(
-        {
-            "installed": {
-                "client_id": client_id,
-                "client_secret": client_secret,
-                "auth_uri": auth_uri,
-                "token_uri": token_uri,
-                "auth_provider_x509_cert_url": auth_provider_x509_cert_url,
-                "redirect_uris": redirect_uris
-            }
-        },
-        scopes=['https://www.googleapis.com/auth/gmail.send']
-    )
-    
-    # Disable browser launch and print the auth URL instead
-    auth_url, _ = flow.authorization_url(prompt='consent')
-    print(f"Please go to this URL: {auth_url}")
-
-    # Ask user for the authorization code manually
-    auth_code = input("Enter the authorization code: ")
-    flow.fetch_token(code=auth_code)
-    
-    credentials = flow.credentials
-    return credentials
+    return {
+        "installed": {
+            "client_id": secrets["installed.client_id"],
+            "client_secret": secrets["installed.client_secret"],
+            "auth_uri": secrets["installed.auth_uri"],
+            "token_uri": secrets["installed.token_uri"],
+            "auth_provider_x509_cert_url": secrets["installed.auth_provider_x509_cert_url"],
+            "redirect_uris": secrets["installed.redirect_uris"]
+        }
+    }
 
 def get_document_table(verification_type):
     documents = {
@@ -118,47 +84,125 @@ def get_document_table(verification_type):
     return table
 
 def send_email(to_email, subject, body):
-    service = get_gmail_service()
-    message = MIMEText(body)
-    message['to'] = to_email
-    message['subject'] = subject
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+    client_config = get_gmail_client_config()
+    service = get_gmail_service(client_config)
+    http = get_credential_manager(client_config).authorized_http()
+    raw_message = build_raw_message(to_email, subject, body)
     try:
-        service.users().messages().send(userId='me', body={'raw': raw_message}).execute()
+        service.users().messages().send(userId='me', body={'raw': raw_message}).execute(http=http)
         return True
     except Exception as e:
         print(f"An error occurred: {e}")
         return False
 
+def send_email_batch(emails, on_result=None):
+    # emails maps a key (the user id) to (to_email, subject, body)
+    client_config = get_gmail_client_config()
+    service = get_gmail_service(client_config)
+    http = get_credential_manager(client_config).authorized_http()
+    raw_messages = {key: build_raw_message(*email) for key, email in emails.items()}
+    bucket = TokenBucket(GMAIL_SEND_RATE, capacity=50)
+    return send_gmail_batch(service, http, raw_messages, on_result=on_result, batch_size=50, bucket=bucket)
+
 def create_ticket(row):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
+    with db_pool.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute("""
             INSERT INTO obf_tickets (user_id, ticket_type, created_at, status, comments)
             VALUES (%s, %s, NOW(), 'Pending', %s)
             RETURNING id, ticket_type, created_at, status
         """, (row['id'], row['ticket_type'], "Awaiting document upload"))
         ticket = cur.fetchone()
-        conn.commit()
-        return ticket
-    finally:
-        cur.close()
-        conn.close()
-
-def fetch_tickets():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        cur.execute("SELECT * FROM obf_tickets WHERE deleted_at IS NULL")
-        return cur.fetchall()
-    finally:
-        cur.close()
-        conn.close()
+    return ticket
+
+def create_tickets(df, chunk_size=1000):
+    # One transaction, one multi-row INSERT per chunk; returns {user_id: ticket}
+    rows = [(row['id'], row['ticket_type'], "Awaiting document upload") for _, row in df.iterrows()]
+    tickets = {}
+    with db_pool.cursor(cursor_factory=RealDictCursor) as cur:
+        for start in range(0, len(rows), chunk_size):
+            created = execute_values(cur, """
+                INSERT INTO obf_tickets (user_id, ticket_type, created_at, status, comments)
+                VALUES %s
+                RETURNING id, user_id, ticket_type, created_at, status
+            """, rows[start:start + chunk_size],
+                template="(%s, %s, NOW(), 'Pending', %s)",
+                page_size=chunk_size,
+                fetch=True)
+            for ticket in created:
+                tickets[ticket['user_id']] = ticket
+    return tickets
+
+@st.cache_resource(show_spinner=False)
+def get_verification_column():
+    # Older obf_users rows carry product_type instead of verification_type
+    with db_pool.cursor() as cur:
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = 'obf_users' AND column_name IN ('verification_type', 'product_type')
+        """)
+        columns = {row[0] for row in cur.fetchall()}
+    for column in ("verification_type", "product_type"):
+        if column in columns:
+            return column
+    return None
+
+def build_user_filters(search, verification_type):
+    clauses = [sql.SQL("deleted_at IS NULL AND is_active = TRUE")]
+    params = []
+    if search:
+        clauses.append(sql.SQL(
+            "(first_name ILIKE %s ESCAPE '\\' OR last_name ILIKE %s ESCAPE '\\' OR email ILIKE %s ESCAPE '\\')"))
+        params += [contains_pattern(search)] * 3
+    verification_column = get_verification_column()
+    if verification_type and verification_column:
+        clauses.append(sql.SQL("{} = %s").format(sql.Identifier(verification_column)))
+        params.append(verification_type)
+    return clauses, params
+
+@st.cache_data(ttl=USER_CACHE_TTL, show_spinner=False)
+def fetch_users_page(search=None, verification_type=None, after_id=None, page_size=50):
+    # Keyset pagination on id; fetches one extra row to tell whether a next page exists
+    clauses, params = build_user_filters(search, verification_type)
+    if after_id is not None:
+        clauses.append(sql.SQL("id > %s"))
+        params.append(after_id)
+    verification_column = get_verification_column()
+    columns = USER_COLUMNS + [verification_column] if verification_column else USER_COLUMNS
+    query = sql.SQL("SELECT {} FROM obf_users WHERE {} ORDER BY id LIMIT %s").format(
+        sql.SQL(", ").join(map(sql.Identifier, columns)),
+        sql.SQL(" AND ").join(clauses),
+    )
+    with db_pool.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(query, params + [page_size + 1])
+        rows = [dict(row) for row in cur.fetchall()]
+    return rows[:page_size], len(rows) > page_size
+
+def fetch_all_users(search=None, verification_type=None, batch_size=1000):
+    rows = []
+    after_id = None
+    while True:
+        page, has_next = fetch_users_page(search, verification_type, after_id, batch_size)
+        rows.extend(page)
+        if not has_next:
+            return pd.DataFrame(rows)
+        after_id = page[-1]['id']
+
+@st.cache_data(ttl=USER_CACHE_TTL, show_spinner=False)
+def fetch_verification_types():
+    verification_column = get_verification_column()
+    if not verification_column:
+        return []
+    query = sql.SQL("SELECT DISTINCT {0} FROM obf_users WHERE deleted_at IS NULL AND is_active = TRUE AND {0} IS NOT NULL ORDER BY {0}").format(
+        sql.Identifier(verification_column)
+    )
+    with db_pool.cursor() as cur:
+        cur.execute(query)
+        return [row[0] for row in cur.fetchall()]
 
 def send_whatsapp_message(to_number, message):
     try:
         from_number = 'whatsapp:+14155238886'  # Your Twilio WhatsApp-enabled number
+        twilio_client = get_twilio_client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
         message = twilio_client.messages.create(
             body=message,
             from_=from_number,
@@ -169,8 +213,12 @@ def send_whatsapp_message(to_number, message):
         return False, f"Error sending WhatsApp message: {e}"
 
 def send_trigger_to_all(df):
+    tickets = create_tickets(df)
+    emails = {}
+    whatsapps = []
+    names = {}
     for _, row in df.iterrows():
-        ticket = create_ticket(row)
+        ticket = tickets[row['id']]
         unique_link = f"https://mjd3mtr4-8502.inc1.devtunnels.ms/?ticket_id={ticket['id']}"
         
         verification_type = row.get('verification_type', row.get('product_type', 'Default'))
@@ -188,62 +236,77 @@ Your ticket number is: {ticket['id']}
 
 Thank you"""
         
-        if send_email(row['email'], "Document Upload Request", message):
-            st.success(f"Email sent to {row['email']}!")
-        
-        success, result = send_whatsapp_message(row['phone_number'], message)
+        names[row['id']] = f"{row['first_name']} {row['last_name']} ({row['email']})"
+        emails[row['id']] = (row['email'], "Document Upload Request", message)
+        whatsapps.append(Notification("whatsapp", row['id'], (row['phone_number'], message)))
+
+    total = len(emails) + len(whatsapps)
+    progress = st.progress(0.0, text="Sending notifications...")
+    sent = {"email": 0, "whatsapp": 0}
+    done = 0
+
+    def report(channel, key, success, detail):
+        nonlocal done
+        done += 1
+        progress.progress(done / total, text=f"Sent {done} of {total} notifications")
         if success:
-            st.success(f"WhatsApp Reminder Sent to {row['first_name']}!")
+            sent[channel] += 1
         else:
-            st.error(result)
-
-def main():
-    col1, col2 = st.columns([1, 6])
-    with col1:
-        st.image("https://www.blenheimchalcot.com/wp-content/uploads/2018/07/modulr-finance-limited-logo-vector.svg", width=200)
-    with col2:
-        st.title("Customer Relationship Management Portal")
-    st.markdown("---")
-
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        cur.execute("SELECT * FROM obf_users WHERE deleted_at IS NULL AND is_active = TRUE")
-        df = pd.DataFrame(cur.fetchall())
-        st.success("Customer Details Fetched Successfully")
-    except Exception as e:
-        st.error(f"Error Loading Customer Data: {e}")
-        return
-    finally:
-        cur.close()
-        conn.close()
-
-    tickets = fetch_tickets()
-
-    if st.button("Contact All Users"):
-        send_trigger_to_all(df)
-
-    st.subheader("Customer Details")
-    for _, row in df.iterrows():
-        with st.container():
-            st.markdown('<div class="customer-card">', unsafe_allow_html=True)
-            col1, col2, col3 = st.columns([3, 2, 2])
-            with col1:
-                st.markdown(f'<div class="customer-info"><strong>{row["first_name"]} {row["last_name"]}</strong></div>', unsafe_allow_html=True)
-                st.markdown(f'<div class="customer-info"><strong>Email:</strong> {row["email"]}</div>', unsafe_allow_html=True)
-                st.markdown(f'<div class="customer-info"><strong>Phone:</strong> {row["phone_number"]}</div>', unsafe_allow_html=True)
-            with col2:
-                verification_type = row.get('verification_type', row.get('product_type', 'Unknown'))
-                st.markdown(f'<div class="customer-info"><strong>Verification Type:</strong> {verification_type}</div>', unsafe_allow_html=True)
-            with col3:
-                st.markdown('<div class="contact-buttons">', unsafe_allow_html=True)
-                if st.button("Contact via Email", key=f"email_{row['id']}"):
-                    ticket = create_ticket(row)
-                    unique_link = f"https://mjd3mtr4-8502.inc1.devtunnels.ms/?ticket_id={ticket['id']}"
-                    verification_type = row.get('verification_type', row.get('product_type', 'Default'))
-                    doc_table = get_document_table(verification_type)
-                    
-                    email_body = f"""Hi {row['first_name']} {row['last_name']},
+            st.error(f"{channel.title()} to {names[key]} failed: {detail}")
+
+    # Emails go out in Gmail batches on a worker thread; results are reported from this thread
+    email_results = queue.Queue()
+
+    def drain_emails(block=False):
+        while True:
+            try:
+                key, success, detail = email_results.get(block=block, timeout=0.5)
+            except queue.Empty:
+                return
+            report("email", key, success, detail)
+
+    def on_whatsapp(_, __, result):
+        report("whatsapp", result.key, result.success, result.detail)
+        drain_emails()
+
+    dispatcher = NotificationDispatcher({"whatsapp": send_whatsapp_message})
+    with ThreadPoolExecutor(max_workers=1) as email_worker:
+        email_job = email_worker.submit(
+            send_email_batch, emails, lambda key, success, detail: email_results.put((key, success, detail))
+        )
+        try:
+            dispatcher.dispatch(whatsapps, on_whatsapp)
+        finally:
+            dispatcher.shutdown()
+        while not email_job.done():
+            drain_emails(block=True)
+        email_job.result()
+        drain_emails()
+
+    st.success(f"Emails sent: {sent['email']}/{len(df)}. WhatsApp reminders sent: {sent['whatsapp']}/{len(df)}.")
+
+@st.fragment
+def render_customer_card(row):
+    # Runs as a fragment so a contact button only reruns this card, not the whole page
+    with st.container():
+        st.markdown('<div class="customer-card">', unsafe_allow_html=True)
+        col1, col2, col3 = st.columns([3, 2, 2])
+        with col1:
+            st.markdown(f'<div class="customer-info"><strong>{row["first_name"]} {row["last_name"]}</strong></div>', unsafe_allow_html=True)
+            st.markdown(f'<div class="customer-info"><strong>Email:</strong> {row["email"]}</div>', unsafe_allow_html=True)
+            st.markdown(f'<div class="customer-info"><strong>Phone:</strong> {row["phone_number"]}</div>', unsafe_allow_html=True)
+        with col2:
+            verification_type = row.get('verification_type', row.get('product_type', 'Unknown'))
+            st.markdown(f'<div class="customer-info"><strong>Verification Type:</strong> {verification_type}</div>', unsafe_allow_html=True)
+        with col3:
+            st.markdown('<div class="contact-buttons">', unsafe_allow_html=True)
+            if st.button("Contact via Email", key=f"email_{row['id']}"):
+                ticket = create_ticket(row)
+                unique_link = f"https://mjd3mtr4-8502.inc1.devtunnels.ms/?ticket_id={ticket['id']}"
+                verification_type = row.get('verification_type', row.get('product_type', 'Default'))
+                doc_table = get_document_table(verification_type)
+                
+                email_body = f"""Hi {row['first_name']} {row['last_name']},
 
 We have reviewed your application for onboarding at Modulr.Please proceed for {verification_type} verification. Upload the following documents to proceed further:
 
@@ -253,17 +316,17 @@ Please use this link to upload: {unique_link}
 Your ticket number is: {ticket['id']}
 
 Thank you"""
-                    
-                    if send_email(row['email'], "Document Upload Request", email_body):
-                        st.success(f"Email sent to {row['email']}!")
                 
-                if st.button("Contact via WhatsApp", key=f"whatsapp_{row['id']}"):
-                    ticket = create_ticket(row)
-                    unique_link = f"https://mjd3mtr4-8502.inc1.devtunnels.ms/?ticket_id={ticket['id']}"
-                    verification_type = row.get('verification_type', row.get('product_type', 'Default'))
-                    doc_table = get_document_table(verification_type)
-                    
-                    whatsapp_message = f"""Hi {row['first_name']} {row['last_name']},
+                if send_email(row['email'], "Document Upload Request", email_body):
+                    st.success(f"Email sent to {row['email']}!")
+            
+            if st.button("Contact via WhatsApp", key=f"whatsapp_{row['id']}"):
+                ticket = create_ticket(row)
+                unique_link = f"https://mjd3mtr4-8502.inc1.devtunnels.ms/?ticket_id={ticket['id']}"
+                verification_type = row.get('verification_type', row.get('product_type', 'Default'))
+                doc_table = get_document_table(verification_type)
+                
+                whatsapp_message = f"""Hi {row['first_name']} {row['last_name']},
 
 We have reviewed your application for {verification_type} verification and request you to upload the following documents to proceed further:
 
@@ -274,15 +337,75 @@ Please use this link to upload: {unique_link}
 Your ticket number is: {ticket['id']}
 
 Thank you"""
-                    
-                    success, result = send_whatsapp_message(row['phone_number'], whatsapp_message)
-                    if success:
-                        st.success(f"WhatsApp Reminder Sent to {row['first_name']}!")
-                    else:
-                        st.error(result)
-
-            st.markdown('</div>', unsafe_allow_html=True)
-            st.markdown('</div>', unsafe_allow_html=True)
+                
+                success, result = send_whatsapp_message(row['phone_number'], whatsapp_message)
+                if success:
+                    st.success(f"WhatsApp Reminder Sent to {row['first_name']}!")
+                else:
+                    st.error(result)
+
+        st.markdown('</div>', unsafe_allow_html=True)
+        st.markdown('</div>', unsafe_allow_html=True)
+
+def main():
+    col1, col2 = st.columns([1, 6])
+    with col1:
+        st.image("https://www.blenheimchalcot.com/wp-content/uploads/2018/07/modulr-finance-limited-logo-vector.svg", width=200)
+    with col2:
+        st.title("Customer Relationship Management Portal")
+    st.markdown("---")
+
+    with st.sidebar.expander("Database pool"):
+        st.json(db_pool.metrics())
+    gmail_error = get_credential_manager(get_gmail_client_config()).refresh_error
+    if gmail_error:
+        st.sidebar.error(f"Gmail token refresh failed, emails may not send: {gmail_error}")
+
+    filter_col1, filter_col2, filter_col3 = st.columns([3, 2, 1])
+    with filter_col1:
+        search = st.text_input("Search by name or email").strip()
+    with filter_col2:
+        verification_type = st.selectbox("Verification type", ["All"] + fetch_verification_types())
+        verification_type = None if verification_type == "All" else verification_type
+    with filter_col3:
+        page_size = st.selectbox("Page size", PAGE_SIZES, index=1)
+
+    # Keyset cursors for the pages visited so far; reset whenever the filters change
+    filters = (search, verification_type, page_size)
+    if st.session_state.get("user_filters") != filters:
+        st.session_state.user_filters = filters
+        st.session_state.page_cursors = [None]
+
+    try:
+        rows, has_next = fetch_users_page(search, verification_type, st.session_state.page_cursors[-1], page_size)
+        st.success("Customer Details Fetched Successfully")
+    except Exception as e:
+        st.error(f"Error Loading Customer Data: {e}")
+        return
+
+    if st.button("Contact All Users"):
+        df = fetch_all_users(search, verification_type)
+        if df.empty:
+            st.info("No customers match the current filters.")
+        else:
+            send_trigger_to_all(df)
+
+    st.subheader("Customer Details")
+    page_number = len(st.session_state.page_cursors)
+    nav_col1, nav_col2, nav_col3 = st.columns([1, 1, 6])
+    with nav_col1:
+        if st.button("Previous", disabled=page_number == 1):
+            st.session_state.page_cursors.pop()
+            st.rerun()
+    with nav_col2:
+        if st.button("Next", disabled=not has_next):
+            st.session_state.page_cursors.append(rows[-1]['id'])
+            st.rerun()
+    with nav_col3:
+        st.caption(f"Page {page_number}")
+
+    for row in rows:
+        render_customer_card(row)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,5 @@
 import streamlit as st
 from PIL import Image
-import PyPDF2
 import os
 import time
 from datetime import datetime
@@ -16,25 +15,39 @@ import uuid
 import pandas as pd
 import psycopg2
 from psycopg2 import sql
+from db import get_pool
+from verification_jobs import DONE, FAILED, PARKED, QUEUED, RUNNING, get_verification_queue
+from document import Document, load_document, raster_cache
+from document_classifier import AUTO_DETECT, classifier_metrics, classify_document, resolve_document_type
+from image_preprocess import preprocess_metrics
+from image_quality import check_quality, quality_metrics
+from model_cascade import cascade_metrics, prewarm_cascades, run_cascade
+from llm_gateway import get_llm_gateway
+from mrz import mrz_metrics, read_passport_mrz
+from statement_dates import fast_path_metrics, local_date_range
+from statement_text import has_text_layer, payslip_text, statement_text
+from streaming_extraction import streaming_metrics
+from verification_cache import cached_extraction, get_verification_cache
 from urllib.parse import urlparse, parse_qs
-from pdf2image import convert_from_bytes
 import io
 from dotenv import load_dotenv
 load_dotenv("myenv/.env")
 st.set_page_config(page_title="DocVal", layout="wide")
-# Database connection
-connection = psycopg2.connect(
+# Database connection pool, shared across sessions
+db_pool = get_pool(
     host=os.getenv("DB_HOST"),
     database=os.getenv("DB_NAME"),
     user=os.getenv("DB_USER"),
     password=os.getenv("DB_PASSWORD")
 )
-cursor = connection.cursor()
 
 # Set up OpenAI API key
 openai.api_key = os.getenv("OPENAI_API_KEY")
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
+# Operational metrics in the sidebar are for staff deployments only
+SHOW_INTERNAL_METRICS = os.getenv("SHOW_INTERNAL_METRICS", "false").lower() == "true"
+
 
 # Helper functions
 st.markdown("""
@@ -197,8 +210,9 @@ def get_ticket_type(ticket_id):
 
     query = sql.SQL("SELECT ticket_type FROM obf_tickets WHERE id = %s")
     try:
-        cursor.execute(query, (ticket_id,))
-        result = cursor.fetchone()
+        with db_pool.cursor() as cursor:
+            cursor.execute(query, (ticket_id,))
+            result = cursor.fetchone()
         return result[0] if result else None
     except psycopg2.Error as e:
         st.error(f"Database error: {e}")
@@ -211,8 +225,9 @@ def get_document_details(ticket_id):
     FROM obf_documents
     WHERE ticket_id = %s
     """
-    cursor.execute(query, (ticket_id,))
-    result = cursor.fetchall()
+    with db_pool.cursor() as cursor:
+        cursor.execute(query, (ticket_id,))
+        result = cursor.fetchall()
     document_links = [row[0] for row in result]
     document_responses = [row[1] for row in result]
     return document_links, document_responses
@@ -220,8 +235,9 @@ def get_document_details(ticket_id):
 
 def get_uuid(ticket_id):
     query = "SELECT user_id FROM obf_tickets WHERE id = %s"
-    cursor.execute(query, (ticket_id,))
-    result = cursor.fetchone()
+    with db_pool.cursor() as cursor:
+        cursor.execute(query, (ticket_id,))
+        result = cursor.fetchone()
     return result[0] if result else "UUID not found."
 
 
@@ -251,17 +267,15 @@ def update_tickets(ticket_id, document_responses):
         SET all_documents_submitted = TRUE
         WHERE id = %s;
     """
-    cursor.execute(update_query, (ticket_id,))
-
-    if all_verified:
-        update_status_query = """
+    update_status_query = """
         UPDATE obf_tickets
         SET status = 'Resolved'
         WHERE id = %s;
-        """
-        cursor.execute(update_status_query, (ticket_id,))
-
-    connection.commit()
+    """
+    with db_pool.cursor() as cursor:
+        cursor.execute(update_query, (ticket_id,))
+        if all_verified:
+            cursor.execute(update_status_query, (ticket_id,))
 
 
 def get_ticket_id_from_url():
@@ -299,26 +313,10 @@ def is_difference_at_least_sixty_days(date1_str, date2_str):
         return False
 
 
-def convert_to_jpg(file_path):
-    _, ext = os.path.splitext(file_path)
-    ext = ext.lower()
-
-    def image_to_base64(image):
-        buffered = BytesIO()
-        image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-    if ext == '.pdf':
-        pdf_document = fitz.open(file_path)
-        page = pdf_document.load_page(0)
-        pix = page.get_pixmap()
-        image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        return image_to_base64(image)
-
-    if ext in ['.png', '.jpeg', '.jpg']:
-        image = Image.open(file_path)
-        rgb_image = image.convert('RGB')
-        return image_to_base64(rgb_image)
+def convert_to_jpg(file_path, document_type=None):
+    # file_path may also be an already-parsed Document; see image_preprocess.PREPROCESS_CONFIGS
+    image_data, _ = load_document(file_path).model_image(document_type)
+    return image_data
 
 
 class Payslip(BaseModel):
@@ -376,23 +374,39 @@ class LicenseOutput(BaseModel):
         description="Find out the license number,Return string with value NULL if you cannot identify")
 
 
-model = ChatOpenAI(model="gpt-4o")
+PAYSLIP_PROMPT = "Verify if the document type is a payslip. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json output parser "
+PAYSLIP_TEXT_PROMPT = "Verify if the document type is a payslip. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD from the payslip text below. Make the output passable to Json output parser "
+PASSPORT_PROMPT = "Verify whether the following document is a passport. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser"
+LICENSE_PROMPT = "Verify whether the following document is a driving license. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser"
+# Opt-in: duplicate slow model calls past the gateway's latency percentile and keep the first answer
+HEDGE_REQUESTS = os.getenv("HEDGE_LLM_REQUESTS", "false").lower() == "true"
+# Bank statements are sent as raw text with no instruction prompt
+BANK_STATEMENT_PROMPT = ""
 
 
-def checkpayslip(file_path):
-    image_data = convert_to_jpg(file_path)
-    message = HumanMessage(
+def image_message(prompt, image_data):
+    return HumanMessage(
         content=[
-            {"type": "text",
-             "text": "Verify if the document type is a payslip. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json output parser "},
+            {"type": "text", "text": prompt},
             {
                 "type": "image_url",
                 "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
             },
         ],
     )
-    structured_model = model.with_structured_output(Payslip)
-    response = structured_model.invoke([message])
+
+
+def extract_payslip(file_path, accept):
+    message = image_message(PAYSLIP_PROMPT, convert_to_jpg(file_path, "Payslip"))
+    return run_cascade("Payslip", Payslip, [message], accept, hedge=HEDGE_REQUESTS)
+
+
+def extract_payslip_text(file_path, accept):
+    text = payslip_text(load_document(file_path))
+    return run_cascade("Payslip", Payslip, f"{PAYSLIP_TEXT_PROMPT}\n\n{text}", accept, hedge=HEDGE_REQUESTS)
+
+
+def score_payslip(response):
     if response.Verification == False:
         return -1
     else:
@@ -404,12 +418,26 @@ def checkpayslip(file_path):
             return 0
 
 
-def checkbankstatement(file_path):
-    loader = PyPDFLoader(file_path)
-    pages = loader.load_and_split()
-    text = " ".join(list(map(lambda page: page.page_content, pages)))
-    structured_model = model.with_structured_output(BankStatement)
-    response = structured_model.invoke(text)
+def checkpayslip(file_path):
+    # Cheaper tiers escalate to the next model only when their answer would fail the document
+    accept = lambda response: score_payslip(response) != 0
+    # Digital PDFs go to the model as text from every page; scans and photos fall back to vision
+    if has_text_layer(load_document(file_path)):
+        response = cached_extraction(file_path, "Payslip", Payslip, PAYSLIP_TEXT_PROMPT,
+                                     lambda: extract_payslip_text(file_path, accept))
+    else:
+        response = cached_extraction(file_path, "Payslip", Payslip, PAYSLIP_PROMPT,
+                                     lambda: extract_payslip(file_path, accept))
+    return score_payslip(response)
+
+
+def extract_bankstatement(file_path, accept):
+    # Header plus the pages holding the first and last transactions, within the token budget
+    text = statement_text(load_document(file_path))
+    return run_cascade("Bank Statement", BankStatement, text, accept, hedge=HEDGE_REQUESTS)
+
+
+def score_bankstatement(response):
     if response.Verification == False:
         return -1
     else:
@@ -418,21 +446,23 @@ def checkbankstatement(file_path):
         return 1 if is_difference_at_least_sixty_days(response.Firstdate, response.Lastdate) else 0
 
 
-def passport_verify(image_path, first_name, last_name):
-    image_data = convert_to_jpg(image_path)
-    structured_model = model.with_structured_output(PassportOutput)
-    message = HumanMessage(
-        content=[
-            {"type": "text",
-             "text": "Verify whether the following document is a passport. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser"},
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
-            },
-        ],
-    )
-    response = structured_model.invoke([message])
+def checkbankstatement(file_path):
+    # A clean transaction-date column settles the 60-day rule without a model call
+    date_range = local_date_range(load_document(file_path))
+    if date_range is not None:
+        return 1 if is_difference_at_least_sixty_days(date_range.first.isoformat(), date_range.last.isoformat()) else 0
+    response = cached_extraction(file_path, "Bank Statement", BankStatement, BANK_STATEMENT_PROMPT,
+                                 lambda: extract_bankstatement(file_path,
+                                                               lambda r: score_bankstatement(r) != 0))
+    return score_bankstatement(response)
 
+
+def extract_passport(image_path, accept):
+    message = image_message(PASSPORT_PROMPT, convert_to_jpg(image_path, "Passport"))
+    return run_cascade("Passport", PassportOutput, [message], accept, hedge=HEDGE_REQUESTS)
+
+
+def score_passport(response, first_name, last_name):
     if not response.verification:
         return -1
 
@@ -456,21 +486,24 @@ def passport_verify(image_path, first_name, last_name):
     return 1
 
 
-def license_verify(image_path, first_name, last_name):
-    image_data = convert_to_jpg(image_path)
-    structured_model = model.with_structured_output(LicenseOutput)
-    message = HumanMessage(
-        content=[
-            {"type": "text",
-             "text": "Verify whether the following document is a driving license. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser"},
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
-            },
-        ],
-    )
-    response = structured_model.invoke([message])
+def passport_verify(image_path, first_name, last_name):
+    # A checksum-valid MRZ is read locally; the model is only asked when it can't be
+    mrz = read_passport_mrz(load_document(image_path))
+    if mrz is not None:
+        response = PassportOutput(verification=True, **mrz.passport_fields())
+    else:
+        response = cached_extraction(image_path, "Passport", PassportOutput, PASSPORT_PROMPT,
+                                     lambda: extract_passport(image_path,
+                                                              lambda r: score_passport(r, first_name, last_name) != 0))
+    return score_passport(response, first_name, last_name)
+
 
+def extract_license(image_path, accept):
+    message = image_message(LICENSE_PROMPT, convert_to_jpg(image_path, "Driving License"))
+    return run_cascade("Driving License", LicenseOutput, [message], accept, hedge=HEDGE_REQUESTS)
+
+
+def score_license(response, first_name, last_name):
     if not response.verification:
         return -1
 
@@ -490,6 +523,13 @@ def license_verify(image_path, first_name, last_name):
     return 1
 
 
+def license_verify(image_path, first_name, last_name):
+    response = cached_extraction(image_path, "Driving License", LicenseOutput, LICENSE_PROMPT,
+                                 lambda: extract_license(image_path,
+                                                         lambda r: score_license(r, first_name, last_name) != 0))
+    return score_license(response, first_name, last_name)
+
+
 def verify_document(document_type, file_path, first_name, last_name):
     if document_type == "Passport":
         return passport_verify(file_path, first_name, last_name)
@@ -521,30 +561,93 @@ def create_document(doc_path, ticketid, document_type, verification_result, user
     check_query = """
     SELECT id FROM obf_documents WHERE ticket_id = %s AND user_id = %s AND document_link LIKE %s
     """
-    doc_link_base = remove_extension(document["Document Link"])
-    cursor.execute(check_query, (ticketid, user_id, f"{doc_link_base}%"))
-    existing_document = cursor.fetchone()
-
-    if existing_document:
-        update_query = """
-        UPDATE obf_documents
-        SET document_name = %s, document_link = %s, verification_response = %s, ticket_id = %s, user_id = %s, modified_at = CURRENT_TIMESTAMP
-        WHERE id = %s
-        """
-        cursor.execute(update_query, (
-            document["Document Name"], document["Document Link"], document["Verification Response"],
-            document["Ticket ID"], document["User ID"], existing_document[0]
-        ))
+    with db_pool.cursor() as cursor:
+        doc_link_base = remove_extension(document["Document Link"])
+        cursor.execute(check_query, (ticketid, user_id, f"{doc_link_base}%"))
+        existing_document = cursor.fetchone()
+
+        if existing_document:
+            update_query = """
+            UPDATE obf_documents
+            SET document_name = %s, document_link = %s, verification_response = %s, ticket_id = %s, user_id = %s, modified_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+            """
+            cursor.execute(update_query, (
+                document["Document Name"], document["Document Link"], document["Verification Response"],
+                document["Ticket ID"], document["User ID"], existing_document[0]
+            ))
+        else:
+            insert_query = """
+            INSERT INTO obf_documents (document_name, document_link, verification_response, ticket_id, user_id, created_at, modified_at)
+            VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            """
+            cursor.execute(insert_query, (
+                document["Document Name"], document["Document Link"], document["Verification Response"],
+                document["Ticket ID"], document["User ID"]
+            ))
+
+
+def run_verification(document_type, document, file_path, ticket_id, user_id):
+    verification_result = verify_document(document_type, document, "Mona", "Lisa")
+    create_document(file_path, ticket_id, document_type, verification_result, user_id)
+    return verification_result
+
+
+verification_queue = get_verification_queue(__file__, run_verification)
+prewarm_cascades({"Payslip": Payslip, "Bank Statement": BankStatement, "Passport": PassportOutput,
+                  "Driving License": LicenseOutput})
+
+
+def show_verification_result(document_type, verification_result):
+    if verification_result == -1:
+        st.error(
+            f"This does not seem to be a valid {document_type.lower()}. Please reupload the requested document."
+        )
+    elif verification_result == 0:
+        st.warning(
+            f"Unable to verify your details. Please reupload {document_type.lower()} with correct details."
+        )
+    elif verification_result == 1:
+        st.success(f"{document_type} Verification Successful.")
     else:
-        insert_query = """
-        INSERT INTO obf_documents (document_name, document_link, verification_response, ticket_id, user_id, created_at, modified_at)
-        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        """
-        cursor.execute(insert_query, (
-            document["Document Name"], document["Document Link"], document["Verification Response"],
-            document["Ticket ID"], document["User ID"]
-        ))
-    connection.commit()
+        st.info("Unexpected result from verification.")
+
+
+def show_job_status(job):
+    document_type = job.kwargs["document_type"]
+    if job.status in (QUEUED, RUNNING):
+        st.info(f"Verifying your {document_type.lower()}...")
+    elif job.status == PARKED:
+        st.warning(f"Verification is busy right now. Your {document_type.lower()} will be verified "
+                   f"automatically in a moment.")
+    elif job.status == FAILED:
+        st.error(f"An error occurred while verifying your {document_type.lower()}: {job.error}")
+    else:
+        show_verification_result(document_type, job.result)
+        # Toast once per job, not on every rerun
+        if job.result == 1 and st.session_state.get("verification_toasted") != job.id:
+            st.session_state.verification_toasted = job.id
+            st.toast(f"{document_type} verified successfully!", icon="✅")
+
+
+@st.fragment(run_every=1)
+def poll_verification_status():
+    job = verification_queue.get(st.session_state.get("verification_job"))
+    if job is None or job.status in (DONE, FAILED):
+        # One full rerun renders the outcome outside this fragment, which stops the polling
+        st.rerun()
+    show_job_status(job)
+
+
+def show_verification_status():
+    # Only a pending job is polled; sessions with no job or a finished one don't rerun every second
+    job = verification_queue.get(st.session_state.get("verification_job"))
+    if job is None:
+        return
+    if job.status in (DONE, FAILED):
+        show_job_status(job)
+    else:
+        poll_verification_status()
 
 
 def main():
@@ -565,8 +668,32 @@ def main():
         unsafe_allow_html=True
     )
 
-    if "last_uploaded_file" not in st.session_state:
-        st.session_state.last_uploaded_file = None
+    if "last_uploaded_digest" not in st.session_state:
+        st.session_state.last_uploaded_digest = None
+
+    # Internal telemetry stays out of the customer-facing portal unless SHOW_INTERNAL_METRICS is set
+    if SHOW_INTERNAL_METRICS:
+        with st.sidebar.expander("Verification cache"):
+            st.json(get_verification_cache().stats())
+        with st.sidebar.expander("Verification queue"):
+            st.json(verification_queue.stats())
+        with st.sidebar.expander("Document classifier"):
+            st.json(classifier_metrics())
+        with st.sidebar.expander("Image quality gate"):
+            st.json(quality_metrics())
+        with st.sidebar.expander("Image preprocessing"):
+            st.json(preprocess_metrics())
+            st.json(raster_cache.stats())
+        with st.sidebar.expander("Statement date fast path"):
+            st.json(fast_path_metrics())
+        with st.sidebar.expander("Passport MRZ"):
+            st.json(mrz_metrics())
+        with st.sidebar.expander("Model cascade"):
+            st.json(cascade_metrics())
+        with st.sidebar.expander("LLM gateway"):
+            st.json(get_llm_gateway().stats())
+        with st.sidebar.expander("Streaming extraction"):
+            st.json(streaming_metrics())
 
     url_ticket_id = get_ticket_id_from_url()
 
@@ -581,8 +708,10 @@ def main():
         if ticket_id:
             ticket_type = get_ticket_type(ticket_id)
             if ticket_type:
-                document_type = st.selectbox(
-                    "Select document type", get_dropdown_names(ticket_type)
+                document_types = get_dropdown_names(ticket_type) or []
+                # Auto-detect is opt-in: the classifier is only sure of text PDFs and passports with a readable MRZ
+                selected_type = st.selectbox(
+                    "Select document type", document_types + [AUTO_DETECT] if document_types else []
                 )
                 uploaded_doc = st.file_uploader(
                     "Upload your document", type=["pdf", "png", "jpg", "jpeg"]
@@ -595,54 +724,62 @@ def main():
             return
 
         if uploaded_doc is not None:
-            file_type = uploaded_doc.type
+            # Parse each upload once; preview, page count, model raster and text layer all share it
+            if st.session_state.get("document_file_id") != uploaded_doc.file_id:
+                st.session_state.document = Document.from_upload(uploaded_doc)
+                st.session_state.document_file_id = uploaded_doc.file_id
+            document = st.session_state.document
             with col3:
-                if file_type in ["image/jpeg", "image/jpg", "image/png"]:
+                if not document.is_pdf:
                     st.text("Image Preview:")
-                    image = Image.open(uploaded_doc)
-                    st.image(image, caption="Uploaded Image", use_column_width=True)
-                elif file_type == "application/pdf":
+                    st.image(document.image, caption="Uploaded Image", use_column_width=True)
+                else:
                     st.text("PDF Preview:")
                     try:
-                        pdf_pages = convert_from_bytes(uploaded_doc.getvalue(), first_page=0, last_page=1)
-                        if pdf_pages:
-                            st.image(pdf_pages[0], caption="First page of PDF", use_column_width=True)
-
-                        pdf_reader = PyPDF2.PdfReader(io.BytesIO(uploaded_doc.getvalue()))
-                        num_pages = len(pdf_reader.pages)
-                        st.write(f"Number of pages: {num_pages}")
+                        st.image(document.preview_image(), caption="First page of PDF", use_column_width=True)
+                        st.write(f"Number of pages: {document.page_count}")
                     except Exception as e:
                         st.error(f"Error processing PDF: {str(e)}")
 
-            if uploaded_doc != st.session_state.last_uploaded_file:
+            # Wrong-type and unreadable uploads are bounced here, before any verification job or model call
+            check_key = (document.digest, selected_type)
+            if st.session_state.get("upload_check_key") != check_key:
+                prediction = classify_document(document, selected_type)
+                document_type, rejection = resolve_document_type(prediction, selected_type, document_types)
+                if rejection is None:
+                    quality = check_quality(document, document_type)
+                    if not quality.ok:
+                        rejection = f"Please reupload your {document_type.lower()}: {quality.reason}."
+                st.session_state.upload_check = (document_type, rejection)
+                st.session_state.upload_check_key = check_key
+            document_type, rejection = st.session_state.upload_check
+            if selected_type == AUTO_DETECT and rejection is None:
+                st.info(f"Detected document type: {document_type}")
+
+            # Only the content hash is kept in session state to spot repeat uploads
+            upload_digest = (document.digest, document_type)
+            if rejection is not None:
+                st.session_state.verification_job = None
+                st.warning(rejection)
+            elif upload_digest != st.session_state.last_uploaded_digest:
                 file_path = save_uploaded_file(
                     uploaded_doc, document_type, get_uuid(ticket_id)
                 )
-                st.session_state.last_uploaded_file = uploaded_doc
+                st.session_state.last_uploaded_digest = upload_digest
 
-                verification_result = verify_document(
-                    document_type, file_path, "Mona", "Lisa"
+                # Verification runs on the worker pool; the status fragment below polls for the result
+                st.session_state.verification_job = verification_queue.submit(
+                    document_type=document_type,
+                    document=document,
+                    file_path=file_path,
+                    ticket_id=ticket_id,
+                    user_id=get_uuid(ticket_id),
                 )
-                create_document(file_path, ticket_id, document_type, verification_result, get_uuid(ticket_id))
-
-                time.sleep(3)
-
-                if verification_result == -1:
-                    st.error(
-                        f"This does not seem to be a valid {document_type.lower()}. Please reupload the requested document."
-                    )
-                elif verification_result == 0:
-                    st.warning(
-                        f"Unable to verify your details. Please reupload {document_type.lower()} with correct details."
-                    )
-                elif verification_result == 1:
-                    st.success(f"{document_type} Verification Successful.")
-                    st.toast(f"{document_type} verified successfully!", icon="✅")
-                else:
-                    st.info("Unexpected result from verification.")
             else:
                 st.info("No new file uploaded, or file already saved.")
 
+        show_verification_status()
+
         if st.button("All documents submitted", key="all_submitted"):
             try:
                 document_links, document_responses = get_document_details(ticket_id)
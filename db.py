@@ -0,0 +1,156 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import streamlit as st
+from psycopg2 import pool as pg_pool
+
+# Errors that mean the connection itself is unusable (dropped by Azure, network blip, ...)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# Pair with LIKE %s ESCAPE '\' so user input can't inject wildcards
+LIKE_ESCAPE = "\\"
+
+
+def contains_pattern(text):
+    # LIKE/ILIKE pattern matching text anywhere, with %, _ and the escape character taken literally
+    for char in (LIKE_ESCAPE, "%", "_"):
+        text = text.replace(char, LIKE_ESCAPE + char)
+    return f"%{text}%"
+
+
+class _IdleKeepingPool(pg_pool.ThreadedConnectionPool):
+    # psycopg2 closes every returned connection once minconn are idle, and opens minconn up front.
+    # Open lazily from minconn, but keep up to max_idle returned connections for reuse.
+
+    def __init__(self, minconn, maxconn, max_idle, **conn_kwargs):
+        super().__init__(minconn, maxconn, **conn_kwargs)
+        self.minconn = max_idle
+
+
+class ConnectionPool:
+    def __init__(self, minconn=1, maxconn=20, max_idle=None, checkout_timeout=10, health_check_after=30,
+                 **conn_kwargs):
+        # By default every connection ever opened stays pooled, so concurrent checkouts reuse them
+        max_idle = maxconn if max_idle is None else min(max_idle, maxconn)
+        self._pool = _IdleKeepingPool(minconn, maxconn, max_idle, **conn_kwargs)
+        # ThreadedConnectionPool raises instead of waiting when exhausted, so gate checkouts
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._checkout_timeout = checkout_timeout
+        self._health_check_after = health_check_after
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._maxconn = maxconn
+        self._metrics = {
+            "checkouts": 0,
+            "in_use": 0,
+            "peak_in_use": 0,
+            "reconnects": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "total_wait_ms": 0.0,
+        }
+
+    def _bump(self, name, value=1):
+        with self._lock:
+            self._metrics[name] += value
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        # Only ping connections that have been idle for a while
+        idle_for = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle_for < self._health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def _checkout(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self._checkout_timeout):
+            self._bump("timeouts")
+            raise pg_pool.PoolError("Timed out waiting for a database connection")
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                self._bump("reconnects")
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._metrics["checkouts"] += 1
+            self._metrics["in_use"] += 1
+            self._metrics["peak_in_use"] = max(self._metrics["peak_in_use"], self._metrics["in_use"])
+            self._metrics["total_wait_ms"] += (time.monotonic() - started) * 1000
+        return conn
+
+    def _release(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            self._bump("in_use", -1)
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except CONNECTION_ERRORS:
+            broken = True
+            self._bump("errors")
+            raise
+        except Exception:
+            self._bump("errors")
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn, broken)
+
+    @contextmanager
+    def cursor(self, cursor_factory=None):
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory=cursor_factory)
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["max_connections"] = self._maxconn
+        metrics["avg_wait_ms"] = metrics["total_wait_ms"] / metrics["checkouts"] if metrics["checkouts"] else 0.0
+        return metrics
+
+    def close(self):
+        self._pool.closeall()
+
+
+# One pool per process, shared by every session and rerun of the app
+@st.cache_resource(show_spinner=False)
+def get_pool(host, database, user, password, minconn=1, maxconn=20, max_idle=None):
+    return ConnectionPool(
+        minconn=minconn,
+        maxconn=maxconn,
+        max_idle=max_idle,
+        host=host,
+        database=database,
+        user=user,
+        password=password,
+    )
@@ -0,0 +1,177 @@
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import fitz
+from PIL import Image
+
+from image_preprocess import PreprocessStats, estimate_image_tokens, get_config, optimize_image, pdf_render_dpi, \
+    prepare_scan, record_stats, to_jpeg
+from statement_text import has_text_layer
+
+# Enough for a sharp preview in the upload column without rendering a full-size page
+PREVIEW_DPI = 96
+RASTER_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class RasterCache:
+    # LRU of rendered pages keyed by (content digest, page, dpi, grayscale), bounded by pixel bytes
+
+    def __init__(self, max_bytes=RASTER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return image
+
+    def put(self, key, image):
+        size = image.width * image.height * len(image.getbands())
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = image
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.width * evicted.height * len(evicted.getbands())
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "bytes": self._bytes}
+
+
+raster_cache = RasterCache()
+
+
+class Document:
+    # One parsed upload shared by the preview, page count, model raster and text layer.
+    # data may be a memoryview (e.g. UploadedFile.getbuffer()), so nothing is copied up front.
+
+    def __init__(self, data, filetype):
+        self.data = data
+        self.filetype = filetype.lower().lstrip(".")
+        self._digest = None
+        self._pdf = None
+        self._image = None
+        # Whether the PDF has extractable text; filled in by statement_text.has_text_layer
+        self.text_layer = None
+        # PyMuPDF handles must not be used from two threads at once
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_upload(cls, uploaded_file):
+        _, ext = os.path.splitext(uploaded_file.name)
+        return cls(uploaded_file.getbuffer(), ext)
+
+    @classmethod
+    def from_path(cls, file_path):
+        _, ext = os.path.splitext(file_path)
+        with open(file_path, "rb") as f:
+            return cls(f.read(), ext)
+
+    @property
+    def is_pdf(self):
+        return self.filetype == "pdf"
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    @property
+    def pdf(self):
+        with self._lock:
+            if self._pdf is None:
+                self._pdf = fitz.open(stream=self.data, filetype="pdf")
+            return self._pdf
+
+    @property
+    def image(self):
+        with self._lock:
+            if self._image is None:
+                self._image = Image.open(BytesIO(self.data))
+                self._image.load()
+            return self._image
+
+    @property
+    def page_count(self):
+        return self.pdf.page_count if self.is_pdf else 1
+
+    def page_text(self, page_number):
+        if not self.is_pdf:
+            return ""
+        with self._lock:
+            return self.pdf.load_page(page_number).get_text()
+
+    def text(self):
+        return "\n".join(self.page_text(n) for n in range(self.page_count))
+
+    def render_page(self, page_number, dpi, grayscale=False):
+        # Rendered pages are shared across reruns and sessions through raster_cache; treat them as read-only
+        dpi = round(dpi)
+        key = (self.digest, page_number, dpi, grayscale)
+        image = raster_cache.get(key)
+        if image is None:
+            colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+            with self._lock:
+                pix = self.pdf.load_page(page_number).get_pixmap(dpi=dpi, colorspace=colorspace)
+            image = Image.frombytes("L" if grayscale else "RGB", [pix.width, pix.height], pix.samples)
+            raster_cache.put(key, image)
+        return image
+
+    def page_size(self, page_number):
+        with self._lock:
+            rect = self.pdf.load_page(page_number).rect
+        return rect.width, rect.height
+
+    def preview_image(self):
+        if not self.is_pdf:
+            return self.image
+        return self.render_page(0, PREVIEW_DPI)
+
+    def model_image(self, document_type=None):
+        # Returns (base64 JPEG, stats) for the first page, sized for the document type
+        config = get_config(document_type)
+        if self.is_pdf:
+            width, height = self.page_size(0)
+            image = self.render_page(0, pdf_render_dpi(width, height, config), config.grayscale)
+            deskewed = False
+            if not has_text_layer(self):
+                image, deskewed = prepare_scan(image)
+            output = to_jpeg(image, config)
+            # A rasterised page has no source image to compare bytes with, so it records none saved;
+            # tokens are compared against PyMuPDF's default 72 dpi render, which is what we used to send
+            stats = PreprocessStats(len(output), len(output), estimate_image_tokens(width, height),
+                                    estimate_image_tokens(*image.size), reencoded=True, deskewed=deskewed)
+            record_stats(stats)
+        else:
+            output, stats = optimize_image(self.image, config, self.data)
+        return base64.b64encode(output).decode("utf-8"), stats
+
+    def close(self):
+        with self._lock:
+            if self._pdf is not None:
+                self._pdf.close()
+                self._pdf = None
+
+
+def load_document(source):
+    # Verifiers accept either an already-parsed Document or a path on disk
+    if isinstance(source, Document):
+        return source
+    return Document.from_path(source)
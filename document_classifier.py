@@ -0,0 +1,84 @@
+import re
+import threading
+from dataclasses import dataclass, field
+
+from mrz import read_passport_mrz
+from statement_text import has_text_layer
+
+KEYWORDS = {
+    "Payslip": ("payslip", "pay slip", "pay advice", "net pay", "gross pay", "paye", "tax code", "ni number",
+                "national insurance", "employer", "pay period"),
+    "Bank Statement": ("statement", "sort code", "account number", "opening balance", "closing balance",
+                       "balance brought forward", "balance carried forward", "iban"),
+    "Driving License": ("driving licence", "driving license", "dvla", "provisional", "licence number"),
+    "Passport": ("passport", "nationality", "place of birth", "authority"),
+}
+# A text layer needs this many keyword hits, and this many more than the runner-up, to count
+MIN_KEYWORD_HITS = 2
+MIN_KEYWORD_LEAD = 2
+# Opt-in last option in the document type selectbox
+AUTO_DETECT = "Detect automatically"
+
+_metrics = {"classified": 0, "confident": 0, "mismatches": 0, "auto_selected": 0}
+_metrics_lock = threading.Lock()
+
+
+@dataclass
+class Prediction:
+    # document_type is only set on hard evidence (text-layer keywords or a valid MRZ); None means unknown
+    document_type: str = None
+    reason: str = None
+    scores: dict = field(default_factory=dict)
+
+
+def keyword_scores(text):
+    text = re.sub(r"\s+", " ", text.lower())
+    return {document_type: sum(text.count(word) > 0 for word in words) for document_type, words in KEYWORDS.items()}
+
+
+def _from_keywords(scores):
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, hits), (_, runner_up) = ranked[0], ranked[1]
+    if hits >= MIN_KEYWORD_HITS and hits - runner_up >= MIN_KEYWORD_LEAD:
+        return best
+    return None
+
+
+def classify_document(document, selected_type):
+    # Cheap local guess at the document type. The MRZ OCR only runs when the customer asked us to
+    # detect the type, so card uploads with an explicit type don't pay for tesseract on the script thread.
+    prediction = Prediction()
+    if has_text_layer(document):
+        prediction.scores = keyword_scores(document.page_text(0))
+        prediction.document_type = _from_keywords(prediction.scores)
+        prediction.reason = "text layer keywords"
+    if prediction.document_type is None and selected_type == AUTO_DETECT and read_passport_mrz(document, record=False):
+        prediction.document_type = "Passport"
+        prediction.reason = "machine-readable zone"
+    with _metrics_lock:
+        _metrics["classified"] += 1
+        _metrics["confident"] += int(prediction.document_type is not None)
+    return prediction
+
+
+def resolve_document_type(prediction, selected_type, document_types):
+    # Returns (document_type, rejection message); document_type is None when the upload is rejected
+    if selected_type is None:
+        return None, "Please select the document type above."
+    if selected_type == AUTO_DETECT:
+        if prediction.document_type in document_types:
+            with _metrics_lock:
+                _metrics["auto_selected"] += 1
+            return prediction.document_type, None
+        return None, "We couldn't tell which document this is. Please select the document type above."
+    if prediction.document_type is not None and prediction.document_type != selected_type:
+        with _metrics_lock:
+            _metrics["mismatches"] += 1
+        return None, (f"This looks like a {prediction.document_type.lower()}, not a {selected_type.lower()}. "
+                      f"Please upload the requested document.")
+    return selected_type, None
+
+
+def classifier_metrics():
+    with _metrics_lock:
+        return dict(_metrics)
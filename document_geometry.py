@@ -0,0 +1,145 @@
+import numpy as np
+from PIL import Image, ImageFilter
+
+# Edges are found on a copy scaled to this long edge; the warp itself runs on the full-size image
+ANALYSIS_LONG_EDGE = 320
+# Outer frame of the photo that is assumed to be background
+BORDER = 0.04
+# Colour distance from the background that counts as document
+MIN_CONTRAST = 40
+# Only crop when the document is a clean quadrilateral that covers a sensible share of the photo
+MIN_DOCUMENT_AREA = 0.2
+MAX_DOCUMENT_AREA = 0.9
+MIN_FILL = 0.9
+MAX_STRAY = 0.05
+# The quad is grown by this share around its centre so the warp never clips the card's edge
+CROP_MARGIN = 0.015
+# Scans are searched for skew within this many degrees, in steps of DESKEW_STEP
+MAX_SKEW = 5.0
+DESKEW_STEP = 0.2
+MIN_SKEW = 0.3
+DESKEW_LONG_EDGE = 1000
+MAX_INK_POINTS = 50000
+INK = 128
+
+
+def _scaled(image, long_edge):
+    scale = min(1.0, long_edge / max(image.size))
+    if scale < 1.0:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.BILINEAR)
+    return image, scale
+
+
+def _polygon_area(corners):
+    x, y = corners[:, 0], corners[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+
+
+def _inside(corners, width, height):
+    # Mask of the pixels inside a convex quad whose corners run clockwise from the top left
+    ys, xs = np.mgrid[0:height, 0:width]
+    inside = np.ones((height, width), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(corners, np.roll(corners, -1, axis=0)):
+        inside &= (x1 - x0) * (ys - y0) - (y1 - y0) * (xs - x0) >= 0
+    return inside
+
+
+def document_mask(image):
+    # Pixels that differ from the colour of the photo's outer frame, with specks and thin lines removed
+    rgb = np.asarray(image.convert("RGB"), dtype=np.float32)
+    height, width, _ = rgb.shape
+    band = max(1, round(min(width, height) * BORDER))
+    border = np.concatenate([rgb[:band].reshape(-1, 3), rgb[-band:].reshape(-1, 3),
+                             rgb[:, :band].reshape(-1, 3), rgb[:, -band:].reshape(-1, 3)])
+    background = np.median(border, axis=0)
+    distance = np.abs(rgb - background).max(axis=2)
+    mask = Image.fromarray(((distance > MIN_CONTRAST) * 255).astype(np.uint8))
+    mask = mask.filter(ImageFilter.MaxFilter(5)).filter(ImageFilter.MinFilter(5))
+    mask = mask.filter(ImageFilter.MinFilter(5)).filter(ImageFilter.MaxFilter(5))
+    return np.asarray(mask) > 0
+
+
+def find_document_quad(image):
+    # Corners (top left, top right, bottom right, bottom left) of the document in image pixels,
+    # or None when the photo has no clear background around a single document
+    small, scale = _scaled(image, ANALYSIS_LONG_EDGE)
+    mask = document_mask(small)
+    height, width = mask.shape
+    ys, xs = np.nonzero(mask)
+    if len(xs) < MIN_DOCUMENT_AREA * width * height:
+        return None
+    total, diff = xs + ys, xs - ys
+    corners = np.array([
+        (xs[total.argmin()], ys[total.argmin()]),
+        (xs[diff.argmax()], ys[diff.argmax()]),
+        (xs[total.argmax()], ys[total.argmax()]),
+        (xs[diff.argmin()], ys[diff.argmin()]),
+    ], dtype=np.float64)
+    area = _polygon_area(corners)
+    if not MIN_DOCUMENT_AREA * width * height <= area <= MAX_DOCUMENT_AREA * width * height:
+        return None
+    inside = _inside(corners, width, height)
+    if not inside.any() or mask[inside].mean() < MIN_FILL or mask[~inside].sum() > MAX_STRAY * area:
+        return None
+    centre = corners.mean(axis=0)
+    corners = centre + (corners - centre) * (1 + CROP_MARGIN)
+    corners = np.clip(corners, 0, [width - 1, height - 1])
+    return (corners + 0.5) / scale
+
+
+def _perspective_coefficients(source, size):
+    # PIL's PERSPECTIVE transform maps each output pixel back to the input, so solve for output -> source
+    width, height = size
+    target = [(0, 0), (width, 0), (width, height), (0, height)]
+    rows, values = [], []
+    for (x, y), (u, v) in zip(target, source):
+        rows.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        rows.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        values += [u, v]
+    return np.linalg.solve(np.array(rows, dtype=np.float64), np.array(values, dtype=np.float64))
+
+
+def crop_document(image):
+    # Perspective-corrected crop of the document in a photo; None leaves the photo as it is
+    corners = find_document_quad(image)
+    if corners is None:
+        return None
+    top_left, top_right, bottom_right, bottom_left = corners
+    width = round(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left)))
+    height = round(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right)))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return image.transform((width, height), Image.PERSPECTIVE, _perspective_coefficients(corners, (width, height)),
+                           Image.BICUBIC)
+
+
+def skew_angle(image):
+    # Angle in degrees that makes the text lines of a scan horizontal: the rotation under which the
+    # ink's row histogram is most peaked
+    small, _ = _scaled(image.convert("L"), DESKEW_LONG_EDGE)
+    ys, xs = np.nonzero(np.asarray(small) < INK)
+    if len(xs) < 100:
+        return 0.0
+    if len(xs) > MAX_INK_POINTS:
+        keep = np.random.default_rng(0).choice(len(xs), MAX_INK_POINTS, replace=False)
+        ys, xs = ys[keep], xs[keep]
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-MAX_SKEW, MAX_SKEW + DESKEW_STEP / 2, DESKEW_STEP):
+        theta = np.radians(angle)
+        rows = np.round(ys * np.cos(theta) - xs * np.sin(theta)).astype(np.int64)
+        counts = np.bincount(rows - rows.min())
+        score = float(np.dot(counts, counts))
+        if score > best_score:
+            best_angle, best_score = round(float(angle), 2), score
+    return best_angle
+
+
+def deskew(image):
+    # Straightens a scanned page; returns the image untouched when it is already within MIN_SKEW
+    angle = skew_angle(image)
+    if abs(angle) < MIN_SKEW:
+        return image
+    fill = 255 if image.mode == "L" else (255, 255, 255)
+    return image.rotate(angle, resample=Image.BICUBIC, fillcolor=fill)
+
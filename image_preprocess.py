@@ -0,0 +1,135 @@
+import math
+import os
+import threading
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from document_geometry import crop_document, deskew
+
+
+@dataclass(frozen=True)
+class PreprocessConfig:
+    max_long_edge: int
+    jpeg_quality: int
+    grayscale: bool
+
+
+# Cards need colour and fine print near the MRZ; payslips and statements are black-on-white text
+PREPROCESS_CONFIGS = {
+    "Passport": PreprocessConfig(max_long_edge=1600, jpeg_quality=85, grayscale=False),
+    "Driving License": PreprocessConfig(max_long_edge=1280, jpeg_quality=85, grayscale=False),
+    "Payslip": PreprocessConfig(max_long_edge=2048, jpeg_quality=75, grayscale=True),
+    "Bank Statement": PreprocessConfig(max_long_edge=2048, jpeg_quality=75, grayscale=True),
+}
+DEFAULT_CONFIG = PreprocessConfig(max_long_edge=2048, jpeg_quality=85, grayscale=False)
+# OpenAI downsamples high-detail images to a 768px shortest side, so anything larger is wasted upload
+MODEL_SHORT_EDGE = 768
+# Never render PDFs above 288 dpi, however small the page
+MAX_PDF_ZOOM = 4
+# Crop photos to the document and straighten scanned pages before encoding
+CORRECT_GEOMETRY = os.getenv("CORRECT_DOCUMENT_GEOMETRY", "true").lower() == "true"
+
+
+@dataclass
+class PreprocessStats:
+    original_bytes: int
+    output_bytes: int
+    original_tokens: int
+    output_tokens: int
+    reencoded: bool
+    cropped: bool = False
+    deskewed: bool = False
+
+
+_totals = {"images": 0, "reencoded": 0, "cropped": 0, "deskewed": 0, "bytes_saved": 0, "tokens_saved": 0}
+_totals_lock = threading.Lock()
+
+
+def get_config(document_type):
+    return PREPROCESS_CONFIGS.get(document_type, DEFAULT_CONFIG)
+
+
+def estimate_image_tokens(width, height):
+    # OpenAI high-detail pricing: fit in 2048x2048, shortest side down to 768, then 170 tokens per 512px tile
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def record_stats(stats):
+    with _totals_lock:
+        _totals["images"] += 1
+        _totals["reencoded"] += int(stats.reencoded)
+        _totals["cropped"] += int(stats.cropped)
+        _totals["deskewed"] += int(stats.deskewed)
+        _totals["bytes_saved"] += stats.original_bytes - stats.output_bytes
+        _totals["tokens_saved"] += stats.original_tokens - stats.output_tokens
+
+
+def preprocess_metrics():
+    with _totals_lock:
+        return dict(_totals)
+
+
+def target_scale(width, height, config):
+    return min(1.0, config.max_long_edge / max(width, height), MODEL_SHORT_EDGE / min(width, height))
+
+
+def _fit(image, config):
+    if config.grayscale:
+        image = image.convert("L")
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    scale = target_scale(*image.size, config)
+    if scale < 1.0:
+        size = (round(image.width * scale), round(image.height * scale))
+        image = image.resize(size, Image.LANCZOS)
+    return image
+
+
+def to_jpeg(image, config):
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=config.jpeg_quality, optimize=True)
+    return buffered.getvalue()
+
+
+def optimize_image(image, config, source_bytes=None):
+    # Returns (jpeg_bytes, stats). source_bytes is passed through untouched when it is
+    # already a JPEG that fits the config and has no background to crop, so we don't pay for a lossy re-encode.
+    original_size = image.size
+    original_bytes = len(source_bytes) if source_bytes is not None else original_size[0] * original_size[1] * 3
+    original_tokens = estimate_image_tokens(*original_size)
+    upright = ImageOps.exif_transpose(image)
+    cropped = crop_document(upright) if CORRECT_GEOMETRY else None
+    mode_ok = image.mode == "L" if config.grayscale else image.mode in ("RGB", "L")
+    if (cropped is None and source_bytes is not None and image.format == "JPEG" and mode_ok
+            and target_scale(*original_size, config) == 1.0):
+        stats = PreprocessStats(original_bytes, original_bytes, original_tokens, original_tokens, reencoded=False)
+        record_stats(stats)
+        return source_bytes, stats
+
+    fitted = _fit(upright if cropped is None else cropped, config)
+    output = to_jpeg(fitted, config)
+    stats = PreprocessStats(original_bytes, len(output), original_tokens, estimate_image_tokens(*fitted.size),
+                            reencoded=True, cropped=cropped is not None)
+    record_stats(stats)
+    return output, stats
+
+
+def prepare_scan(image):
+    # Returns (image, deskewed) for a page rendered from a scanned PDF
+    if not CORRECT_GEOMETRY:
+        return image, False
+    straightened = deskew(image)
+    return straightened, straightened is not image
+
+
+def pdf_render_dpi(width, height, config):
+    # DPI that renders a page (size in points) straight at the target size instead of
+    # PyMuPDF's 72 dpi default
+    zoom = min(MAX_PDF_ZOOM, config.max_long_edge / max(width, height), MODEL_SHORT_EDGE / min(width, height))
+    return zoom * 72
@@ -0,0 +1,109 @@
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image
+
+from statement_text import has_text_layer
+
+# Scores are measured on a copy scaled to this long edge so thresholds don't depend on camera resolution
+ANALYSIS_LONG_EDGE = 1024
+# Scanned PDFs are checked at this resolution
+SCAN_DPI = 150
+SATURATED = 250
+
+
+@dataclass(frozen=True)
+class QualityThresholds:
+    min_short_edge: int
+    min_sharpness: float
+    min_brightness: float
+    max_brightness: float
+    # Share of blown-out pixels allowed; None for white-paper documents where most pixels are near 255
+    max_glare: float = None
+
+
+# Starting points: the sample cards in Passport/ and Driving License/ (204-493px short edge, sharpness
+# several hundred) pass, and a 4px Gaussian blur of them (sharpness < 5) fails
+QUALITY_THRESHOLDS = {
+    "Passport": QualityThresholds(min_short_edge=200, min_sharpness=50, min_brightness=40, max_brightness=220,
+                                  max_glare=0.08),
+    "Driving License": QualityThresholds(min_short_edge=200, min_sharpness=50, min_brightness=40,
+                                         max_brightness=220, max_glare=0.08),
+    "Payslip": QualityThresholds(min_short_edge=600, min_sharpness=100, min_brightness=60, max_brightness=252),
+    "Bank Statement": QualityThresholds(min_short_edge=600, min_sharpness=100, min_brightness=60,
+                                        max_brightness=252),
+}
+DEFAULT_THRESHOLDS = QualityThresholds(min_short_edge=200, min_sharpness=50, min_brightness=40, max_brightness=250)
+
+
+@dataclass
+class QualityResult:
+    ok: bool
+    reason: str = None
+    scores: dict = field(default_factory=dict)
+
+
+_metrics = {"checked": 0, "passed": 0, "rejected": {}}
+_metrics_lock = threading.Lock()
+
+
+def sharpness(gray):
+    # Variance of the 4-neighbour Laplacian; low means few sharp edges, i.e. blur
+    laplacian = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+                 - 4 * gray[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def _analysis_array(image):
+    gray = image.convert("L")
+    scale = min(1.0, ANALYSIS_LONG_EDGE / max(gray.size))
+    if scale < 1.0:
+        gray = gray.resize((round(gray.width * scale), round(gray.height * scale)), Image.BILINEAR)
+    return np.asarray(gray, dtype=np.float32)
+
+
+def assess(image, thresholds, check_resolution=True):
+    gray = _analysis_array(image)
+    scores = {
+        "short_edge": min(image.size),
+        "sharpness": round(sharpness(gray), 1),
+        "brightness": round(float(gray.mean()), 1),
+        "glare": round(float((gray >= SATURATED).mean()), 3),
+    }
+    if check_resolution and scores["short_edge"] < thresholds.min_short_edge:
+        return QualityResult(False, "the image resolution is too low", scores)
+    if scores["brightness"] < thresholds.min_brightness:
+        return QualityResult(False, "the image is too dark", scores)
+    if scores["brightness"] > thresholds.max_brightness:
+        return QualityResult(False, "the image is overexposed", scores)
+    if thresholds.max_glare is not None and scores["glare"] > thresholds.max_glare:
+        return QualityResult(False, "there is glare on the document", scores)
+    # Checked last: dark or washed-out photos also score low on sharpness
+    if scores["sharpness"] < thresholds.min_sharpness:
+        return QualityResult(False, "the image is blurry", scores)
+    return QualityResult(True, scores=scores)
+
+
+def check_quality(document, document_type):
+    # Runs before a verification job is queued; digital PDFs pass straight through
+    thresholds = QUALITY_THRESHOLDS.get(document_type, DEFAULT_THRESHOLDS)
+    if not document.is_pdf:
+        result = assess(document.image, thresholds)
+    elif has_text_layer(document):
+        result = QualityResult(True)
+    else:
+        # A scan's pixel size is set by the render DPI, so only sharpness and exposure mean anything
+        result = assess(document.render_page(0, SCAN_DPI, grayscale=True), thresholds, check_resolution=False)
+    with _metrics_lock:
+        _metrics["checked"] += 1
+        if result.ok:
+            _metrics["passed"] += 1
+        else:
+            _metrics["rejected"][result.reason] = _metrics["rejected"].get(result.reason, 0) + 1
+    return result
+
+
+def quality_metrics():
+    with _metrics_lock:
+        return {**_metrics, "rejected": dict(_metrics["rejected"])}
@@ -15,6 +15,11 @@ from langchain_core.output_parsers import PydanticOutputParser
 from langchain_community.document_loaders import PyPDFLoader
 #from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.pydantic_v1 import BaseModel, Field
+from document import load_document
+from model_cascade import run_cascade
+from statement_dates import local_date_range
+from statement_text import has_text_layer, payslip_text, statement_text
+from verification_cache import cached_extraction
 
 
 load_dotenv('myenv/.env')
@@ -58,30 +63,11 @@ def is_difference_at_least_sixty_days(date1_str, date2_str):
     else:
         return False
     
-model = ChatOpenAI(model="gpt-4o")
-
-def convert_to_jpg(file_path):
-    _, ext = os.path.splitext(file_path)
-    ext = ext.lower()
-    def image_to_base64(image):
-        buffered = BytesIO()
-        image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-    # Convert PDF to JPG and return base64 encoding of the first page
-    if ext == '.pdf':
-        pdf_document = fitz.open(file_path)
-        page = pdf_document.load_page(0)  # Load the first page
-        pix = page.get_pixmap()
-        image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        return image_to_base64(image)
-
-    # Convert PNG or JPEG to JPG and return base64 encoding
-    if ext in ['.png', '.jpeg', '.jpg']:
-        image = Image.open(file_path)
-        rgb_image = image.convert('RGB')
-        return image_to_base64(rgb_image)
-    
+def convert_to_jpg(file_path, document_type=None):
+    # file_path may also be an already-parsed Document; see image_preprocess.PREPROCESS_CONFIGS
+    image_data, _ = load_document(file_path).model_image(document_type)
+    return image_data
+
 class Payslip(BaseModel):
     Verification: bool = Field(description="if Document Type is payslip return True")
     FirstName: str = Field(description="First Name in the name")
@@ -107,19 +93,27 @@ class BankStatement(BaseModel):
                 return True
         return False
 
-def checkpayslip(file_path) :
-    image_data = convert_to_jpg(file_path)
+PAYSLIP_PROMPT = "Verify if the document type is a payslip. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json output parser "
+PAYSLIP_TEXT_PROMPT = "Verify if the document type is a payslip. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD from the payslip text below. Make the output passable to Json output parser "
+
+def extract_payslip(file_path, accept) :
+    image_data = convert_to_jpg(file_path, "Payslip")
     message = HumanMessage(
     content=[
-        {"type": "text", "text": "Verify if the document type is a payslip. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json output parser "},
+        {"type": "text", "text": PAYSLIP_PROMPT},
         {
             "type": "image_url",
             "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
         },
         ],
     )
-    structured_model = model.with_structured_output(Payslip)
-    response = structured_model.invoke([message])
+    return run_cascade("Payslip", Payslip, [message], accept)
+
+def extract_payslip_text(file_path, accept) :
+    text = payslip_text(load_document(file_path))
+    return run_cascade("Payslip", Payslip, f"{PAYSLIP_TEXT_PROMPT}\n\n{text}", accept)
+
+def score_payslip(response) :
     if response.Verification == False :
         return -1
     else :
@@ -133,12 +127,22 @@ def checkpayslip(file_path) :
         else :
             return 0
 
-def checkbankstatement(file_path) :
-    loader = PyPDFLoader(file_path)
-    pages = loader.load_and_split()
-    text = " ".join(list(map(lambda page: page.page_content, pages)))
-    structured_model = model.with_structured_output(BankStatement)
-    response = structured_model.invoke(text)
+def checkpayslip(file_path) :
+    # Cheaper tiers escalate to the next model only when their answer would fail the document
+    accept = lambda response: score_payslip(response) != 0
+    # Digital PDFs go to the model as text from every page; scans and photos fall back to vision
+    if has_text_layer(load_document(file_path)) :
+        response = cached_extraction(file_path, "Payslip", Payslip, PAYSLIP_TEXT_PROMPT, lambda: extract_payslip_text(file_path, accept))
+    else :
+        response = cached_extraction(file_path, "Payslip", Payslip, PAYSLIP_PROMPT, lambda: extract_payslip(file_path, accept))
+    return score_payslip(response)
+
+def extract_bankstatement(file_path, accept) :
+    # Header plus the pages holding the first and last transactions, within the token budget
+    text = statement_text(load_document(file_path))
+    return run_cascade("Bank Statement", BankStatement, text, accept)
+
+def score_bankstatement(response) :
     if response.Verification == False :
         return "Incorrect Document Uploaded"
     else :
@@ -148,3 +152,13 @@ def checkbankstatement(file_path) :
         
         #logic for comparing given first and last name to db
         return is_difference_at_least_sixty_days(response.Firstdate, response.Lastdate)
+
+def checkbankstatement(file_path) :
+    # A clean transaction-date column settles the 60-day rule without a model call
+    date_range = local_date_range(load_document(file_path))
+    if date_range is not None :
+        return is_difference_at_least_sixty_days(date_range.first.isoformat(), date_range.last.isoformat())
+    # Bank statements are sent as raw text, so there is no prompt to key the cache on
+    response = cached_extraction(file_path, "Bank Statement", BankStatement, "",
+                                 lambda: extract_bankstatement(file_path, lambda r: r.Verification == False or score_bankstatement(r) is True))
+    return score_bankstatement(response)
@@ -11,6 +11,9 @@ import base64
 import os
 import datetime
 from dateutil.relativedelta import relativedelta
+from document import load_document
+from model_cascade import run_cascade
+from verification_cache import cached_extraction
 
 
 
@@ -25,24 +28,24 @@ class LicenseOutput(BaseModel):
 
 
 
+LICENSE_PROMPT = "Verify whther the following document is a driving license. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser. THe dirving license template is as such Header : County Driving License 1. Surname, 2 . First name "
+
 def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
+  # Downscaled JPEG sized for the model rather than the raw upload bytes
+  image_data, _ = load_document(image_path).model_image("Driving License")
+  return image_data
   
-def extract_values(image_data):
-    
-    model = ChatOpenAI(model="gpt-4o")
-    structured_model=model.with_structured_output(LicenseOutput)
+def extract_values(image_data, accept):
     message = HumanMessage(
         content=[
-            {"type": "text", "text": "Verify whther the following document is a driving license. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser. THe dirving license template is as such Header : County Driving License 1. Surname, 2 . First name "},
+            {"type": "text", "text": LICENSE_PROMPT},
             {
                 "type": "image_url",
                 "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
             },
         ],
     )
-    response = structured_model.invoke([message])
+    response = run_cascade("Driving License", LicenseOutput, [message], accept)
     #parser = JsonOutputParser(pydantic_object=PassportOutput)
     print(response)
 
@@ -176,9 +179,9 @@ def verify_and_match(document, first_name, last_name):
     
 def license_verify(image_path,first_name,last_name):
     
-    image_data = encode_image(image_path)
-
-    output_dict = extract_values(image_data)
+    output_dict = cached_extraction(image_path, "Driving License", LicenseOutput, LICENSE_PROMPT,
+                                    lambda: extract_values(encode_image(image_path),
+                                                           lambda r: verify_and_match(r, first_name, last_name) != 0))
 
     
     
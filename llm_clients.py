@@ -0,0 +1,74 @@
+import asyncio
+import os
+import threading
+
+import httpx
+import streamlit as st
+from langchain_openai import ChatOpenAI
+
+from llm_gateway import get_llm_gateway
+from streaming_extraction import StreamingExtractor
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+# Idle connections stay open long enough to span the gap between uploads
+HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=300)
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+_runnables = {}
+_runnables_lock = threading.Lock()
+
+
+def get_base_url():
+    # Read at call time so values loaded by load_dotenv after import still apply
+    return os.getenv("OPENAI_BASE_URL", DEFAULT_BASE_URL)
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_client():
+    # One keep-alive pool for every session and worker thread in the process
+    return httpx.Client(base_url=get_base_url(), limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_http_client():
+    # Only ever awaited on the llm_gateway event loop
+    return httpx.AsyncClient(base_url=get_base_url(), limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+@st.cache_resource(show_spinner=False)
+def get_chat_model(name):
+    # Retries belong to llm_gateway, which knows the caller's deadline
+    return ChatOpenAI(model=name, base_url=get_base_url(), http_client=get_http_client(),
+                      http_async_client=get_async_http_client(), max_retries=0)
+
+
+def get_structured_model(name, schema, streaming=False):
+    # Schema conversion and tool binding happen once per (model, schema), not once per upload
+    key = (name, schema, streaming)
+    with _runnables_lock:
+        runnable = _runnables.get(key)
+        if runnable is None:
+            if streaming:
+                runnable = StreamingExtractor(get_chat_model(name), schema)
+            else:
+                runnable = get_chat_model(name).with_structured_output(schema, include_raw=True)
+            _runnables[key] = runnable
+        return runnable
+
+
+async def _warm_connection(client):
+    # Any authenticated request will do; it leaves a TLS connection in the async pool the gateway calls through
+    try:
+        await client.get("/models", headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"})
+    except httpx.HTTPError:
+        pass
+
+
+@st.cache_resource(show_spinner=False)
+def prewarm(_schemas, streaming=False):
+    # _schemas maps model name -> schemas it will be asked for; runs once per process, off the script thread
+    for name, schemas in _schemas.items():
+        for schema in schemas:
+            get_structured_model(name, schema, streaming)
+    # httpx.AsyncClient connections belong to the loop that opened them, so warm up on the gateway's loop
+    return asyncio.run_coroutine_threadsafe(_warm_connection(get_async_http_client()), get_llm_gateway().loop)
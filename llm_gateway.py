@@ -0,0 +1,270 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import openai
+import streamlit as st
+
+from token_budget import BudgetExhausted, TokenBudget, get_limits
+from verification_jobs import ParkJob
+
+DEFAULT_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+# Wall-clock budget for one model call, retries and queueing included
+DEFAULT_DEADLINE = float(os.getenv("LLM_DEADLINE_SECONDS", "90"))
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 20.0
+LATENCY_WINDOW = 500
+# Opt-in hedging fires a duplicate request once the call has run longer than this latency percentile
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 15.0
+# Consecutive calls that exhaust their retries on provider errors (429s excluded) to open the breaker,
+# and how long it stays open
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitOpen(ParkJob):
+    pass
+
+
+class CircuitBreaker:
+    # Closed -> open after BREAKER_THRESHOLD failed calls in a row; after the cooldown one probe
+    # call is let through, and its outcome closes or reopens the breaker
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0}
+
+    def allow(self):
+        # Returns True when this call is the half-open probe; raises CircuitOpen while open
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                self._probing = True
+                return True
+            self._stats["rejected"] += 1
+        raise CircuitOpen("model provider is degraded", retry_after=max(remaining, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release(self):
+        # A probe that ended without a provider verdict (budget, deadline) lets the next call probe instead
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.threshold):
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+            self._probing = False
+
+    def stats(self):
+        with self._lock:
+            state = "closed" if self._opened_at is None else "half-open" if self._probing else "open"
+            return {**self._stats, "state": state, "consecutive_failures": self._failures}
+
+
+def is_retryable(error):
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class LLMGateway:
+    # Every verifier's model call goes through one event loop on a background thread, so the limit
+    # on concurrent OpenAI requests holds across all Streamlit sessions and verification workers
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, deadline=DEFAULT_DEADLINE, max_attempts=MAX_ATTEMPTS):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="llm-gateway", daemon=True)
+        self._thread.start()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._budgets = {}
+        self.breaker = CircuitBreaker()
+        self._stats = {"calls": 0, "waiting": 0, "in_flight": 0, "retries": 0, "timeouts": 0, "failures": 0,
+                       "hedges": 0, "hedge_wins": 0}
+
+    def _bump(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _budget(self, model):
+        with self._lock:
+            if model not in self._budgets:
+                self._budgets[model] = TokenBudget(*get_limits(model))
+            return self._budgets[model]
+
+    async def _admit(self, budget, tokens, expires):
+        # Holds the request until the model's TPM/RPM window has room for it
+        waited = 0.0
+        while True:
+            delay, entry = budget.reserve(tokens)
+            if entry is not None:
+                if waited:
+                    budget.record_wait(waited)
+                return entry
+            if delay >= expires - time.monotonic():
+                raise BudgetExhausted(f"no token budget within the deadline ({tokens} tokens)", retry_after=delay)
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def hedge_delay(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return latencies[min(int(len(latencies) * HEDGE_PERCENTILE), len(latencies) - 1)]
+
+    async def _invoke_once(self, runnable, input, hedge, budget, tokens):
+        primary = asyncio.ensure_future(runnable.ainvoke(input))
+        tasks = {primary}
+        try:
+            if not hedge:
+                return await primary
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            if not done:
+                # The duplicate is paid for too, so it only goes out if the budget has room right now
+                _, entry = budget.reserve(tokens) if budget else (0.0, True)
+                if entry is not None:
+                    self._bump("hedges")
+                    tasks.add(asyncio.ensure_future(runnable.ainvoke(input)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._bump("hedge_wins")
+                        return task.result()
+            raise primary.exception()
+        finally:
+            # Whichever request lost, or all of them if the deadline hit, is cancelled
+            for task in tasks:
+                task.cancel()
+
+    async def _call(self, runnable, input, deadline, model, tokens, hedge):
+        probe = self.breaker.allow()
+        try:
+            return await self._admitted_call(runnable, input, deadline, model, tokens, hedge)
+        finally:
+            if probe:
+                self.breaker.release()
+
+    async def _admitted_call(self, runnable, input, deadline, model, tokens, hedge):
+        expires = time.monotonic() + deadline
+        budget = self._budget(model) if model else None
+        entry = await self._admit(budget, tokens, expires) if budget else None
+        self._bump("waiting")
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=expires - time.monotonic())
+        except asyncio.TimeoutError:
+            self._bump("timeouts")
+            if entry is not None:
+                budget.release(entry)
+            raise DeadlineExceeded(f"no model slot free within {deadline:.0f}s")
+        finally:
+            self._bump("waiting", -1)
+        self._bump("in_flight")
+        start = time.monotonic()
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                remaining = expires - time.monotonic()
+                try:
+                    result = await asyncio.wait_for(self._invoke_once(runnable, input, hedge, budget, tokens),
+                                                    timeout=remaining)
+                    self.breaker.record_success()
+                    if entry is not None:
+                        raw = result.get("raw") if isinstance(result, dict) else result
+                        usage = getattr(raw, "usage_metadata", None)
+                        if usage:
+                            budget.settle(entry, usage["input_tokens"] + usage["output_tokens"])
+                    return result
+                except asyncio.TimeoutError:
+                    self._bump("timeouts")
+                    self.breaker.record_failure()
+                    raise DeadlineExceeded(f"model call exceeded {deadline:.0f}s")
+                except Exception as error:
+                    if not is_retryable(error):
+                        # The provider answered, so it is up even if this request was bad
+                        self.breaker.record_success()
+                        raise
+                    # Full jitter, but never sooner than the server asked for
+                    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                    delay = max(delay, _retry_after(error) or 0)
+                    if attempt == self.max_attempts or delay >= expires - time.monotonic():
+                        # One failure per call once retries are spent; throttling is not an outage
+                        if not isinstance(error, openai.RateLimitError):
+                            self.breaker.record_failure()
+                        raise
+                    self._bump("retries")
+                    await asyncio.sleep(delay)
+        except Exception:
+            self._bump("failures")
+            raise
+        finally:
+            self._semaphore.release()
+            with self._lock:
+                self._stats["in_flight"] -= 1
+                self._stats["calls"] += 1
+                self._latencies.append(time.monotonic() - start)
+
+    def invoke(self, runnable, input, deadline=None, model=None, tokens=0, hedge=False):
+        # Blocking entry point for worker threads; the call itself runs via ainvoke on the gateway loop.
+        # With model set, the estimated tokens are admitted against that model's TPM/RPM budget first.
+        # Raises CircuitOpen or BudgetExhausted (both verification_jobs.ParkJob) without calling out while the
+        # provider is degraded or the model's window is full.
+        future = asyncio.run_coroutine_threadsafe(
+            self._call(runnable, input, deadline or self.deadline, model, tokens, hedge), self.loop)
+        return future.result()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            latencies = sorted(self._latencies)
+            budgets = dict(self._budgets)
+        stats["avg_seconds"] = sum(latencies) / len(latencies) if latencies else 0.0
+        stats["p95_seconds"] = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        stats["hedge_delay_seconds"] = self.hedge_delay()
+        stats["breaker"] = self.breaker.stats()
+        stats["budgets"] = {model: budget.stats() for model, budget in budgets.items()}
+        return stats
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm_gateway():
+    return LLMGateway()
@@ -0,0 +1,196 @@
+import base64
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+import google_auth_httplib2
+import httplib2
+import streamlit as st
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from twilio.rest import Client
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+TOKEN_PATH = "token.json"
+# Gmail rejects batches with more than 100 calls
+GMAIL_BATCH_LIMIT = 100
+# Gmail allows 250 quota units/s per user and messages.send costs 100 units
+GMAIL_SEND_RATE = 2.5
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class GmailCredentialManager:
+    def __init__(self, client_config, token_path=TOKEN_PATH, scopes=SCOPES, refresh_margin=300):
+        self.client_config = client_config
+        self.token_path = token_path
+        self.scopes = scopes
+        # Refresh this many seconds before the access token expires
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._refresher = None
+        self._stopped = threading.Event()
+        # Last background refresh failure, shown in the CRM sidebar; None once a refresh succeeds
+        self.refresh_error = None
+
+    def _load(self):
+        if os.path.exists(self.token_path):
+            return Credentials.from_authorized_user_file(self.token_path, self.scopes)
+        # No stored token yet: do the interactive consent once and persist the result
+        flow = InstalledAppFlow.from_client_config(self.client_config, scopes=self.scopes)
+        auth_url, _ = flow.authorization_url(prompt='consent')
+        print(f"Please go to this URL: {auth_url}")
+        auth_code = input("Enter the authorization code: ")
+        flow.fetch_token(code=auth_code)
+        return flow.credentials
+
+    def _persist(self):
+        with open(self.token_path, "w") as token_file:
+            token_file.write(self._credentials.to_json())
+
+    def _expires_soon(self):
+        if not self._credentials.expiry:
+            return False
+        return self._credentials.expiry - datetime.utcnow() < timedelta(seconds=self.refresh_margin)
+
+    def _refresh_if_needed(self):
+        if self._credentials is None:
+            self._credentials = self._load()
+            self._persist()
+        if not self._credentials.valid or self._expires_soon():
+            self._credentials.refresh(Request())
+            self._persist()
+
+    def credentials(self):
+        with self._lock:
+            self._refresh_if_needed()
+            return self._credentials
+
+    def authorized_http(self):
+        # httplib2.Http is not thread-safe, so every sending thread gets its own
+        if getattr(self._local, "http", None) is None:
+            self._local.http = google_auth_httplib2.AuthorizedHttp(self.credentials(), http=httplib2.Http())
+        return self._local.http
+
+    def _background_refresh(self):
+        # Only ever refreshes an existing token; loading and the interactive consent flow stay on the
+        # foreground path, so a missing or revoked token can't leave this thread waiting on input()
+        if self._credentials is None or not self._credentials.refresh_token:
+            return
+        if not self._credentials.valid or self._expires_soon():
+            self._credentials.refresh(Request())
+            self._persist()
+
+    def _refresh_loop(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                try:
+                    self._background_refresh()
+                    self.refresh_error = None
+                    expiry = self._credentials.expiry if self._credentials else None
+                except Exception as e:
+                    print(f"Gmail token refresh failed: {e}")
+                    self.refresh_error = str(e)
+                    expiry = None
+            if expiry:
+                wait = (expiry - datetime.utcnow()).total_seconds() - self.refresh_margin
+            else:
+                wait = 60
+            self._stopped.wait(max(wait, 30))
+
+    def start_background_refresh(self):
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="gmail-token-refresh", daemon=True)
+            self._refresher.start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def build_raw_message(to_email, subject, body):
+    message = MIMEText(body)
+    message['to'] = to_email
+    message['subject'] = subject
+    return base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+
+
+def _is_retryable(exception):
+    if isinstance(exception, HttpError):
+        return exception.resp.status in RETRYABLE_STATUSES
+    return True
+
+
+def send_gmail_batch(service, http, raw_messages, on_result=None, batch_size=GMAIL_BATCH_LIMIT,
+                     max_attempts=3, bucket=None):
+    # raw_messages maps a caller key (e.g. user id) to a base64url-encoded message.
+    # Returns {key: (success, detail)}; on_result(key, success, detail) fires as each message settles.
+    batch_size = min(batch_size, GMAIL_BATCH_LIMIT)
+    results = {}
+    pending = list(raw_messages)
+
+    def settle(key, success, detail):
+        results[key] = (success, detail)
+        if on_result:
+            on_result(key, success, detail)
+
+    for attempt in range(1, max_attempts + 1):
+        retry = []
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            if bucket:
+                bucket.acquire(len(chunk))
+
+            def callback(request_id, response, exception, chunk=chunk):
+                key = chunk[int(request_id)]
+                if exception is None:
+                    settle(key, True, f"Email sent. Message id: {response['id']}")
+                elif _is_retryable(exception) and attempt < max_attempts:
+                    retry.append(key)
+                else:
+                    settle(key, False, f"An error occurred: {exception}")
+
+            batch = service.new_batch_http_request(callback=callback)
+            for index, key in enumerate(chunk):
+                send = service.users().messages().send(userId='me', body={'raw': raw_messages[key]})
+                batch.add(send, request_id=str(index))
+            try:
+                batch.execute(http=http)
+            except Exception as e:
+                # The whole batch request failed, so nothing in it was delivered
+                for key in chunk:
+                    if key in results or key in retry:
+                        continue
+                    if attempt < max_attempts:
+                        retry.append(key)
+                    else:
+                        settle(key, False, f"An error occurred: {e}")
+        if not retry:
+            break
+        pending = retry
+        time.sleep(2 ** attempt + random.random())
+    return results
+
+
+@st.cache_resource(show_spinner=False)
+def get_credential_manager(client_config):
+    manager = GmailCredentialManager(client_config)
+    manager.start_background_refresh()
+    return manager
+
+
+@st.cache_resource(show_spinner=False)
+def get_gmail_service(client_config):
+    manager = get_credential_manager(client_config)
+    return build('gmail', 'v1', credentials=manager.credentials(), cache_discovery=False)
+
+
+@st.cache_resource(show_spinner=False)
+def get_twilio_client(account_sid, auth_token):
+    return Client(account_sid, auth_token)
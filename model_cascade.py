@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from llm_clients import get_structured_model, prewarm
+from llm_gateway import CircuitOpen, get_llm_gateway
+from token_budget import BudgetExhausted, estimate_tokens
+
+
+@dataclass(frozen=True)
+class Tier:
+    model: str
+    # USD per million tokens
+    input_cost: float
+    output_cost: float
+
+
+TIERS = {
+    "gpt-4o-mini": Tier("gpt-4o-mini", input_cost=0.15, output_cost=0.60),
+    "gpt-4o": Tier("gpt-4o", input_cost=2.50, output_cost=10.00),
+}
+# Cheapest first. Override per document type with e.g. MODEL_CASCADE_DRIVING_LICENSE="gpt-4o"
+CASCADES = {
+    "Passport": ("gpt-4o-mini", "gpt-4o"),
+    "Driving License": ("gpt-4o-mini", "gpt-4o"),
+    "Payslip": ("gpt-4o-mini", "gpt-4o"),
+    "Bank Statement": ("gpt-4o-mini", "gpt-4o"),
+}
+DEFAULT_CASCADE = ("gpt-4o",)
+# Stream tool calls and stop at verification=false instead of paying for the full extraction
+STREAM_EXTRACTION = os.getenv("LLM_STREAM_EXTRACTION", "true").lower() == "true"
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_cascade(document_type):
+    override = os.getenv("MODEL_CASCADE_" + document_type.upper().replace(" ", "_"))
+    if override:
+        return tuple(name.strip() for name in override.split(",") if name.strip())
+    return CASCADES.get(document_type, DEFAULT_CASCADE)
+
+
+def prewarm_cascades(schemas):
+    # schemas maps document type -> output schema; builds every tier's runnable and opens a connection
+    by_model = {}
+    for document_type, schema in schemas.items():
+        for name in get_cascade(document_type):
+            by_model.setdefault(name, []).append(schema)
+    return prewarm(by_model, STREAM_EXTRACTION)
+
+
+def _record(name, seconds, usage, escalated, failed=False, downgraded=False):
+    tier = TIERS.get(name)
+    input_tokens = usage.get("input_tokens", 0)
+    output_tokens = usage.get("output_tokens", 0)
+    cost = (input_tokens * tier.input_cost + output_tokens * tier.output_cost) / 1e6 if tier else 0.0
+    with _metrics_lock:
+        stats = _metrics.setdefault(name, {"calls": 0, "escalations": 0, "failures": 0, "downgrades": 0, "seconds": 0.0,
+                                           "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0})
+        stats["calls"] += 1
+        stats["escalations"] += int(escalated)
+        stats["failures"] += int(failed)
+        stats["downgrades"] += int(downgraded)
+        stats["seconds"] += seconds
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+        stats["cost_usd"] += cost
+
+
+def run_cascade(document_type, schema, messages, accept, hedge=False):
+    # Tries each tier in turn and returns the first parsed response accept() is happy with.
+    # A tier that errors or can't fill the schema escalates too; the last tier's answer is final.
+    # If a later tier has no token budget left in time, an earlier tier's answer is used instead;
+    # with no earlier answer, BudgetExhausted (a ParkJob) reaches the verification queue.
+    cascade = get_cascade(document_type)
+    tokens = estimate_tokens(messages)
+    fallback = None
+    for i, name in enumerate(cascade):
+        last = i == len(cascade) - 1
+        structured_model = get_structured_model(name, schema, STREAM_EXTRACTION)
+        start = time.perf_counter()
+        try:
+            output = get_llm_gateway().invoke(structured_model, messages, model=name, tokens=tokens,
+                                              hedge=hedge)
+        except CircuitOpen:
+            # Every tier shares the provider, so there is nothing to escalate to
+            _record(name, time.perf_counter() - start, {}, escalated=False, failed=True)
+            raise
+        except BudgetExhausted:
+            # Never escalate for budget: the pricier tier has less headroom. Use what we have or park the job
+            _record(name, time.perf_counter() - start, {}, escalated=False, failed=True, downgraded=fallback is not None)
+            if fallback is not None:
+                return fallback
+            raise
+        except Exception:
+            _record(name, time.perf_counter() - start, {}, escalated=not last, failed=True)
+            if last:
+                raise
+            continue
+        usage = getattr(output["raw"], "usage_metadata", None) or {}
+        response = output["parsed"]
+        if last:
+            _record(name, time.perf_counter() - start, usage, escalated=False)
+            if response is None:
+                raise output["parsing_error"] or ValueError(f"{name} returned no {schema.__name__}")
+            return response
+        escalate = response is None or not accept(response)
+        _record(name, time.perf_counter() - start, usage, escalated=escalate)
+        if not escalate:
+            return response
+        fallback = response or fallback
+
+
+def cascade_metrics():
+    with _metrics_lock:
+        metrics = {name: dict(stats) for name, stats in _metrics.items()}
+    for stats in metrics.values():
+        stats["avg_seconds"] = stats["seconds"] / stats["calls"] if stats["calls"] else 0.0
+    return metrics
@@ -0,0 +1,167 @@
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+
+from PIL import ImageOps
+
+from document_geometry import crop_document
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+# ICAO 9303 TD3 (passport booklet): two lines of 44 characters at the foot of the data page
+TD3_LENGTH = 44
+MRZ_LINE = re.compile(r"^[A-Z0-9<]{%d}$" % TD3_LENGTH)
+WEIGHTS = (7, 3, 1)
+# The MRZ sits in the bottom quarter of the data page; OCR only that strip of the cropped page
+MRZ_STRIP = 0.25
+OCR_DPI = 300
+OCR_CONFIG = "--psm 6 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789<"
+# Digit fields that OCR most often misreads as letters
+DIGIT_FIXES = str.maketrans("OQDIL", "00011")
+COUNTRY_NAMES = {"GBR": "United Kingdom"}
+
+# Upload-time classification and verification both read the MRZ; keep recent results by content digest
+RECENT_RESULTS = 64
+
+_recent = OrderedDict()
+_metrics = {"mrz": 0, "fallback": 0, "checksum_failures": 0}
+_metrics_lock = threading.Lock()
+
+
+@dataclass
+class PassportMRZ:
+    passport_number: str
+    nationality: str
+    surname: str
+    given_names: str
+    birth_date: date
+    expiry_date: date
+
+    def passport_fields(self):
+        # Field values in the shape the passport verifiers' PassportOutput expects
+        return {
+            "first_name": self.given_names.split(" ")[0],
+            "last_name": self.surname,
+            "expiry_date": self.expiry_date.isoformat(),
+            "nationality": COUNTRY_NAMES.get(self.nationality, self.nationality),
+            "passport_number": self.passport_number,
+        }
+
+
+def check_digit(value):
+    total = 0
+    for i, char in enumerate(value):
+        if char.isdigit():
+            n = int(char)
+        elif char.isalpha():
+            n = ord(char) - ord("A") + 10
+        else:
+            n = 0
+        total += n * WEIGHTS[i % 3]
+    return str(total % 10)
+
+
+def _date(value, future):
+    # YYMMDD; expiry dates are always this century, birth dates are never in the future
+    year, month, day = int(value[:2]), int(value[2:4]), int(value[4:6])
+    year += 2000
+    if not future and year > date.today().year:
+        year -= 100
+    return date(year, month, day)
+
+
+def _fix_digits(line2):
+    # Dates and check digits are numeric-only, so letters OCR'd there can only be misread digits
+    chars = list(line2)
+    for i in (9, *range(13, 20), *range(21, 28), 43):
+        chars[i] = chars[i].translate(DIGIT_FIXES)
+    return "".join(chars)
+
+
+def parse_td3(line1, line2):
+    # Returns a PassportMRZ when every check digit matches, otherwise None
+    if not (line1.startswith("P") and MRZ_LINE.match(line1) and MRZ_LINE.match(line2)):
+        return None
+    line2 = _fix_digits(line2)
+    number, nationality, birth, expiry = line2[0:9], line2[10:13], line2[13:19], line2[21:27]
+    checks = [
+        (number, line2[9]),
+        (birth, line2[19]),
+        (expiry, line2[27]),
+        (line2[0:10] + line2[13:20] + line2[21:43], line2[43]),
+    ]
+    # The personal number check digit may be '<' when the field is empty
+    if line2[42] != "<" or line2[28:42].strip("<"):
+        checks.append((line2[28:42], line2[42]))
+    if any(check_digit(value) != digit for value, digit in checks):
+        with _metrics_lock:
+            _metrics["checksum_failures"] += 1
+        return None
+    surname, _, given = line1[5:].partition("<<")
+    try:
+        return PassportMRZ(
+            passport_number=number.replace("<", ""),
+            nationality=nationality.replace("<", ""),
+            surname=surname.replace("<", " ").strip(),
+            given_names=" ".join(given.replace("<", " ").split()),
+            birth_date=_date(birth, future=False),
+            expiry_date=_date(expiry, future=True),
+        )
+    except ValueError:
+        return None
+
+
+def find_mrz(text):
+    lines = [line.replace(" ", "").replace("«", "<").upper() for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    for line1, line2 in zip(lines, lines[1:]):
+        mrz = parse_td3(line1, line2)
+        if mrz is not None:
+            return mrz
+    return None
+
+
+def _ocr_mrz(image):
+    if pytesseract is None:
+        return None
+    image = ImageOps.exif_transpose(image)
+    # In a phone shot the bottom of the frame is often table or hand, so find the page first
+    image = (crop_document(image) or image).convert("L")
+    strip = image.crop((0, int(image.height * (1 - MRZ_STRIP)), image.width, image.height))
+    try:
+        return find_mrz(pytesseract.image_to_string(strip, config=OCR_CONFIG))
+    except pytesseract.TesseractNotFoundError:
+        return None
+
+
+def read_passport_mrz(document, record=True):
+    # Text layer first for PDFs, then OCR of the bottom strip; None means the model has to read the page
+    with _metrics_lock:
+        cached = document.digest in _recent
+        mrz = _recent.get(document.digest)
+    if not cached:
+        if document.is_pdf:
+            mrz = find_mrz(document.page_text(0)) or _ocr_mrz(document.render_page(0, OCR_DPI, grayscale=True))
+        else:
+            mrz = _ocr_mrz(document.image)
+    with _metrics_lock:
+        _recent[document.digest] = mrz
+        _recent.move_to_end(document.digest)
+        while len(_recent) > RECENT_RESULTS:
+            _recent.popitem(last=False)
+        if record:
+            _metrics["mrz" if mrz is not None else "fallback"] += 1
+    return mrz
+
+
+def mrz_metrics():
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    total = metrics["mrz"] + metrics["fallback"]
+    metrics["hit_rate"] = metrics["mrz"] / total if total else 0.0
+    return metrics
@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+# Twilio's default WhatsApp sender throughput is well above what we need, so we cap it ourselves.
+# Email goes through messaging_clients.send_gmail_batch instead.
+DEFAULT_LIMITS = {
+    "whatsapp": {"concurrency": 8, "rate": 10, "burst": 10},
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+@dataclass
+class Notification:
+    channel: str
+    key: object
+    args: tuple
+
+
+@dataclass
+class DeliveryResult:
+    channel: str
+    key: object
+    success: bool
+    detail: str = ""
+
+
+class Provider:
+    def __init__(self, send, concurrency, rate, burst):
+        self.send = send
+        self.bucket = TokenBucket(rate, burst)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def deliver(self, notification):
+        self.bucket.acquire()
+        try:
+            outcome = self.send(*notification.args)
+        except Exception as e:
+            return DeliveryResult(notification.channel, notification.key, False, str(e))
+        # send_email returns a bool, send_whatsapp_message returns (success, detail)
+        if isinstance(outcome, tuple):
+            success, detail = outcome
+        else:
+            success, detail = bool(outcome), ""
+        return DeliveryResult(notification.channel, notification.key, success, detail)
+
+
+class NotificationDispatcher:
+    def __init__(self, senders, limits=None):
+        limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.providers = {
+            channel: Provider(send, **limits[channel])
+            for channel, send in senders.items()
+        }
+
+    def dispatch(self, notifications, on_progress=None):
+        # on_progress runs on the calling thread, so it is safe to update Streamlit widgets from it
+        futures = [
+            self.providers[n.channel].executor.submit(self.providers[n.channel].deliver, n)
+            for n in notifications
+        ]
+        results = []
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            results.append(result)
+            if on_progress:
+                on_progress(done, len(futures), result)
+        return results
+
+    def shutdown(self):
+        for provider in self.providers.values():
+            provider.executor.shutdown(wait=False)
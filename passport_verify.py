@@ -11,6 +11,10 @@ import base64
 import os
 import datetime
 from dateutil.relativedelta import relativedelta
+from document import load_document
+from model_cascade import run_cascade
+from mrz import read_passport_mrz
+from verification_cache import cached_extraction
 
 
 
@@ -27,24 +31,24 @@ class PassportOutput(BaseModel):
 
 
 
+PASSPORT_PROMPT = "Verify whther the following document is a passport. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser"
+
 def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
+  # Downscaled JPEG sized for the model rather than the raw upload bytes
+  image_data, _ = load_document(image_path).model_image("Passport")
+  return image_data
   
-def extract_values(image_data):
-    
-    model = ChatOpenAI(model="gpt-4o")
-    structured_model=model.with_structured_output(PassportOutput)
+def extract_values(image_data, accept):
     message = HumanMessage(
         content=[
-            {"type": "text", "text": "Verify whther the following document is a passport. Give me Verification as a boolean, First Name, Last Name and date as YYYY-MM-DD in the image. Make the output passable to Json Output Parser"},
+            {"type": "text", "text": PASSPORT_PROMPT},
             {
                 "type": "image_url",
                 "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
             },
         ],
     )
-    response = structured_model.invoke([message])
+    response = run_cascade("Passport", PassportOutput, [message], accept)
     #parser = JsonOutputParser(pydantic_object=PassportOutput)
     print(response)
 
@@ -151,9 +155,14 @@ def verify_and_match(document, first_name, last_name):
     
 def passport_verify(image_path,first_name,last_name):
     
-    image_data = encode_image(image_path)
-
-    output_dict = extract_values(image_data)
+    # A checksum-valid MRZ is read locally; the model is only asked when it can't be
+    mrz = read_passport_mrz(load_document(image_path))
+    if mrz is not None:
+        return verify_and_match(PassportOutput(verification=True, **mrz.passport_fields()), first_name, last_name)
+
+    output_dict = cached_extraction(image_path, "Passport", PassportOutput, PASSPORT_PROMPT,
+                                    lambda: extract_values(encode_image(image_path),
+                                                           lambda r: verify_and_match(r, first_name, last_name) != 0))
 
     
     
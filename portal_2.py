@@ -1,6 +1,5 @@
 import streamlit as st
 from PIL import Image
-import PyPDF2
 import os
 import time
 from datetime import datetime
@@ -12,31 +11,44 @@ from io import BytesIO
 from langchain_core.messages import HumanMessage
 from langchain_openai import ChatOpenAI
 from langchain_core.pydantic_v1 import BaseModel, Field
-from passport_verify import passport_verify
-from license_verify import license_verify
-from income_verify import checkbankstatement, checkpayslip
+from passport_verify import PassportOutput, passport_verify
+from license_verify import LicenseOutput, license_verify
+from income_verify import BankStatement, Payslip, checkbankstatement, checkpayslip
 import uuid
 import pandas as pd
 import psycopg2
 from psycopg2 import sql
+from db import get_pool
+from verification_jobs import DONE, FAILED, PARKED, QUEUED, RUNNING, get_verification_queue
+from document import Document, raster_cache
+from document_classifier import AUTO_DETECT, classifier_metrics, classify_document, resolve_document_type
+from image_preprocess import preprocess_metrics
+from image_quality import check_quality, quality_metrics
+from model_cascade import cascade_metrics, prewarm_cascades
+from llm_gateway import get_llm_gateway
+from mrz import mrz_metrics
+from statement_dates import fast_path_metrics
+from streaming_extraction import streaming_metrics
+from verification_cache import get_verification_cache
 from urllib.parse import urlparse, parse_qs
-from pdf2image import convert_from_bytes
 import io 
 
 # Adjust PATH for Homebrew
 os.environ['PATH'] += os.pathsep + '/opt/homebrew/bin'
 
+# Operational metrics in the sidebar are for staff deployments only
+SHOW_INTERNAL_METRICS = os.getenv("SHOW_INTERNAL_METRICS", "false").lower() == "true"
+
 # Streamlit page configuration
 st.set_page_config(page_title="Document Upload Portal", layout="wide")
 
-# Database connection
-connection = psycopg2.connect(
+# Database connection pool, shared across sessions
+db_pool = get_pool(
     host='bci-rd.postgres.database.azure.com',
     database='modulr_crm',
     user='pgadmin',
     password='5y62<Rluh'
 )
-cursor = connection.cursor()
 
 def load_css(file_path):
     with open(file_path) as f:
@@ -66,8 +78,9 @@ def get_ticket_type(ticket_id):
     
     query = sql.SQL("SELECT ticket_type FROM obf_tickets WHERE id = %s")
     try:
-        cursor.execute(query, (ticket_id,))
-        result = cursor.fetchone()
+        with db_pool.cursor() as cursor:
+            cursor.execute(query, (ticket_id,))
+            result = cursor.fetchone()
         return result[0] if result else None
     except psycopg2.Error as e:
         st.error(f"Database error: {e}")
@@ -79,16 +92,18 @@ def get_document_details(ticket_id):
     FROM obf_documents
     WHERE ticket_id = %s
     """
-    cursor.execute(query, (ticket_id,))
-    result = cursor.fetchall()
+    with db_pool.cursor() as cursor:
+        cursor.execute(query, (ticket_id,))
+        result = cursor.fetchall()
     document_links = [row[0] for row in result]
     document_responses = [row[1] for row in result]
     return document_links, document_responses
 
 def get_uuid(ticket_id):
     query = "SELECT user_id FROM obf_tickets WHERE id = %s"
-    cursor.execute(query, (ticket_id,))
-    result = cursor.fetchone()
+    with db_pool.cursor() as cursor:
+        cursor.execute(query, (ticket_id,))
+        result = cursor.fetchone()
     return result[0] if result else "UUID not found."
 
 def save_uploaded_file(uploaded_file, folder_path, save_name):
@@ -137,30 +152,30 @@ def create_document(doc_path, ticketid, document_type, verification_result, user
     check_query = """
     SELECT id FROM obf_documents WHERE ticket_id = %s AND user_id = %s AND document_link LIKE %s
     """
-    doc_link_base = remove_extension(document["Document Link"])
-    cursor.execute(check_query, (ticketid, user_id, f"{doc_link_base}%"))
-    existing_document = cursor.fetchone()
-
-    if existing_document:
-        update_query = """
-        UPDATE obf_documents
-        SET document_name = %s, document_link = %s, verification_response = %s, ticket_id = %s, user_id = %s, modified_at = CURRENT_TIMESTAMP
-        WHERE id = %s
-        """
-        cursor.execute(update_query, (
-            document["Document Name"], document["Document Link"], document["Verification Response"],
-            document["Ticket ID"], document["User ID"], existing_document[0]
-        ))
-    else:
-        insert_query = """
-        INSERT INTO obf_documents (document_name, document_link, verification_response, ticket_id, user_id, created_at, modified_at)
-        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        """
-        cursor.execute(insert_query, (
-            document["Document Name"], document["Document Link"], document["Verification Response"],
-            document["Ticket ID"], document["User ID"]
-        ))
-    connection.commit()
+    with db_pool.cursor() as cursor:
+        doc_link_base = remove_extension(document["Document Link"])
+        cursor.execute(check_query, (ticketid, user_id, f"{doc_link_base}%"))
+        existing_document = cursor.fetchone()
+
+        if existing_document:
+            update_query = """
+            UPDATE obf_documents
+            SET document_name = %s, document_link = %s, verification_response = %s, ticket_id = %s, user_id = %s, modified_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+            """
+            cursor.execute(update_query, (
+                document["Document Name"], document["Document Link"], document["Verification Response"],
+                document["Ticket ID"], document["User ID"], existing_document[0]
+            ))
+        else:
+            insert_query = """
+            INSERT INTO obf_documents (document_name, document_link, verification_response, ticket_id, user_id, created_at, modified_at)
+            VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            """
+            cursor.execute(insert_query, (
+                document["Document Name"], document["Document Link"], document["Verification Response"],
+                document["Ticket ID"], document["User ID"]
+            ))
 
 def update_tickets(ticket_id, document_responses):
     all_verified = all(response == "Verified" for response in document_responses)
@@ -170,21 +185,76 @@ def update_tickets(ticket_id, document_responses):
         SET all_documents_submitted = TRUE
         WHERE id = %s;
     """
-    cursor.execute(update_query, (ticket_id,))
-
-    if all_verified:
-        update_status_query = """
+    update_status_query = """
         UPDATE obf_tickets
         SET status = 'Resolved'
         WHERE id = %s;
-        """
-        cursor.execute(update_status_query, (ticket_id,))
-
-    connection.commit()
+    """
+    with db_pool.cursor() as cursor:
+        cursor.execute(update_query, (ticket_id,))
+        if all_verified:
+            cursor.execute(update_status_query, (ticket_id,))
 
 def get_ticket_id_from_url():
     return st.query_params.get("ticket_id", None)
 
+def run_verification(document_type, document, file_path, ticket_id, user_id):
+    verification_result = verify_document(document_type, document, "Mona", "Lisa")
+    create_document(file_path, ticket_id, document_type, verification_result, user_id)
+    return verification_result
+
+verification_queue = get_verification_queue(__file__, run_verification)
+prewarm_cascades({"Payslip": Payslip, "Bank Statement": BankStatement, "Passport": PassportOutput,
+                  "Driving License": LicenseOutput})
+
+def show_verification_result(document_type, verification_result):
+    if verification_result == -1:
+        st.error(
+            f"This does not seem to be a valid {document_type.lower()}. Please reupload the requested document."
+        )
+    elif verification_result == 0:
+        st.warning(
+            f"Unable to verify your details. Please reupload {document_type.lower()} with correct details."
+        )
+    elif verification_result == 1:
+        st.success(f"{document_type} Verification Successful.")
+    else:
+        st.info("Unexpected result from verification.")
+
+def show_job_status(job):
+    document_type = job.kwargs["document_type"]
+    if job.status in (QUEUED, RUNNING):
+        st.info(f"Verifying your {document_type.lower()}...")
+    elif job.status == PARKED:
+        st.warning(f"Verification is busy right now. Your {document_type.lower()} will be verified "
+                   f"automatically in a moment.")
+    elif job.status == FAILED:
+        st.error(f"An error occurred while verifying your {document_type.lower()}: {job.error}")
+    else:
+        show_verification_result(document_type, job.result)
+        # Toast once per job, not on every rerun
+        if job.result == 1 and st.session_state.get("verification_toasted") != job.id:
+            st.session_state.verification_toasted = job.id
+            st.toast(f"{document_type} verified successfully!", icon="✅")
+
+@st.fragment(run_every=1)
+def poll_verification_status():
+    job = verification_queue.get(st.session_state.get("verification_job"))
+    if job is None or job.status in (DONE, FAILED):
+        # One full rerun renders the outcome outside this fragment, which stops the polling
+        st.rerun()
+    show_job_status(job)
+
+def show_verification_status():
+    # Only a pending job is polled; sessions with no job or a finished one don't rerun every second
+    job = verification_queue.get(st.session_state.get("verification_job"))
+    if job is None:
+        return
+    if job.status in (DONE, FAILED):
+        show_job_status(job)
+    else:
+        poll_verification_status()
+
 def main():
     st.image("https://cdn.asp.events/CLIENT_CL_Conf_BDA05934_5056_B731_4C9EEBBE0C2416C2/sites/PayExpo-2020/media/libraries/sponsor/Modulr-Logo-CMYK-420x155.png/fit-in/700x9999/filters:no_upscale()", width=200)
     st.title("Document Validator")
@@ -198,8 +268,32 @@ def main():
     )
     
 
-    if "last_uploaded_file" not in st.session_state:
-        st.session_state.last_uploaded_file = None
+    if "last_uploaded_digest" not in st.session_state:
+        st.session_state.last_uploaded_digest = None
+
+    # Internal telemetry stays out of the customer-facing portal unless SHOW_INTERNAL_METRICS is set
+    if SHOW_INTERNAL_METRICS:
+        with st.sidebar.expander("Verification cache"):
+            st.json(get_verification_cache().stats())
+        with st.sidebar.expander("Verification queue"):
+            st.json(verification_queue.stats())
+        with st.sidebar.expander("Document classifier"):
+            st.json(classifier_metrics())
+        with st.sidebar.expander("Image quality gate"):
+            st.json(quality_metrics())
+        with st.sidebar.expander("Image preprocessing"):
+            st.json(preprocess_metrics())
+            st.json(raster_cache.stats())
+        with st.sidebar.expander("Statement date fast path"):
+            st.json(fast_path_metrics())
+        with st.sidebar.expander("Passport MRZ"):
+            st.json(mrz_metrics())
+        with st.sidebar.expander("Model cascade"):
+            st.json(cascade_metrics())
+        with st.sidebar.expander("LLM gateway"):
+            st.json(get_llm_gateway().stats())
+        with st.sidebar.expander("Streaming extraction"):
+            st.json(streaming_metrics())
 
     # Get ticket_id from URL parameter
     url_ticket_id = get_ticket_id_from_url()
@@ -214,8 +308,10 @@ def main():
         if ticket_id:
             ticket_type = get_ticket_type(ticket_id)
             if ticket_type:
-                document_type = st.selectbox(
-                    "Select document type", get_dropdown_names(ticket_type)
+                document_types = get_dropdown_names(ticket_type) or []
+                # Auto-detect is opt-in: the classifier is only sure of text PDFs and passports with a readable MRZ
+                selected_type = st.selectbox(
+                    "Select document type", document_types + [AUTO_DETECT] if document_types else []
                 )
                 uploaded_doc = st.file_uploader(
                     "Upload your document", type=["pdf", "png", "jpg", "jpeg"]
@@ -228,58 +324,62 @@ def main():
             return  # Exit the function if no ticket ID is provided
     
         if uploaded_doc is not None:
-            file_type = uploaded_doc.type
-            # Preview for image files
+            # Parse each upload once; preview, page count, model raster and text layer all share it
+            if st.session_state.get("document_file_id") != uploaded_doc.file_id:
+                st.session_state.document = Document.from_upload(uploaded_doc)
+                st.session_state.document_file_id = uploaded_doc.file_id
+            document = st.session_state.document
             with col3:
-                if file_type in ["image/jpeg", "image/jpg", "image/png"]:
+                if not document.is_pdf:
                     st.text("Image Preview:")
-                    image = Image.open(uploaded_doc)
-                    st.image(image, caption="Uploaded Image", use_column_width=True)
-                # Preview for PDF files
-                elif file_type == "application/pdf":
+                    st.image(document.image, caption="Uploaded Image", use_column_width=True)
+                else:
                     st.text("PDF Preview:")
                     try:
-                        # Convert the first page of the PDF to an image
-                        pdf_pages = convert_from_bytes(uploaded_doc.getvalue(), first_page=0, last_page=1)
-                        if pdf_pages:
-                            st.image(pdf_pages[0], caption="First page of PDF", use_column_width=True)
-                        
-                        # Get additional information about the PDF
-                        pdf_reader = PyPDF2.PdfReader(io.BytesIO(uploaded_doc.getvalue()))
-                        num_pages = len(pdf_reader.pages)
-                        st.write(f"Number of pages: {num_pages}")
+                        st.image(document.preview_image(), caption="First page of PDF", use_column_width=True)
+                        st.write(f"Number of pages: {document.page_count}")
                     except Exception as e:
                         st.error(f"Error processing PDF: {str(e)}")
 
-            if uploaded_doc != st.session_state.last_uploaded_file:
+            # Wrong-type and unreadable uploads are bounced here, before any verification job or model call
+            check_key = (document.digest, selected_type)
+            if st.session_state.get("upload_check_key") != check_key:
+                prediction = classify_document(document, selected_type)
+                document_type, rejection = resolve_document_type(prediction, selected_type, document_types)
+                if rejection is None:
+                    quality = check_quality(document, document_type)
+                    if not quality.ok:
+                        rejection = f"Please reupload your {document_type.lower()}: {quality.reason}."
+                st.session_state.upload_check = (document_type, rejection)
+                st.session_state.upload_check_key = check_key
+            document_type, rejection = st.session_state.upload_check
+            if selected_type == AUTO_DETECT and rejection is None:
+                st.info(f"Detected document type: {document_type}")
+
+            # Only the content hash is kept in session state to spot repeat uploads
+            upload_digest = (document.digest, document_type)
+            if rejection is not None:
+                st.session_state.verification_job = None
+                st.warning(rejection)
+            elif upload_digest != st.session_state.last_uploaded_digest:
                 file_path = save_uploaded_file(
                     uploaded_doc, document_type, get_uuid(ticket_id)
                 )
-                st.session_state.last_uploaded_file = uploaded_doc
+                st.session_state.last_uploaded_digest = upload_digest
 
-                verification_result = verify_document(
-                    document_type, file_path, "Mona", "Lisa"
+                # Verification runs on the worker pool; the status fragment below polls for the result
+                st.session_state.verification_job = verification_queue.submit(
+                    document_type=document_type,
+                    document=document,
+                    file_path=file_path,
+                    ticket_id=ticket_id,
+                    user_id=get_uuid(ticket_id),
                 )
-                create_document(file_path, ticket_id, document_type, verification_result, get_uuid(ticket_id))
-
-                time.sleep(3)
-                
-                if verification_result == -1:
-                    st.error(
-                        f"This does not seem to be a valid {document_type.lower()}. Please reupload the requested document."
-                    )
-                elif verification_result == 0:
-                    st.warning(
-                        f"Unable to verify your details. Please reupload {document_type.lower()} with correct details."
-                    )
-                elif verification_result == 1:
-                    st.success(f"{document_type} Verification Successful.")
-                    st.toast(f"{document_type} verified successfully!", icon="✅")
-                else:
-                    st.info("Unexpected result from verification.")
             else:
                 st.info("No new file uploaded, or file already saved.")
 
+        show_verification_status()
+
         if st.button("All documents submitted", key="all_submitted"):
             try:
                 document_links, document_responses = get_document_details(ticket_id)
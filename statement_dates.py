@@ -0,0 +1,104 @@
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+from statement_text import select_statement_pages
+
+MONTHS = {
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+
+# Transaction dates lead the line in every UK statement layout we've seen.
+# Numeric dates are read day-first.
+NUMERIC_DATE = re.compile(r"^\s*(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{2}|\d{4})\b")
+ISO_DATE = re.compile(r"^\s*(\d{4})-(\d{2})-(\d{2})\b")
+TEXT_DATE = re.compile(r"^\s*(\d{1,2})(?:st|nd|rd|th)?\s+([A-Za-z]{3})[a-z]*\.?,?(?:\s+(\d{4}|\d{2}))?\b")
+
+STATEMENT_KEYWORDS = ("statement", "sort code", "account number", "balance")
+MIN_TRANSACTIONS = 5
+# Share of consecutive dates that must run in one direction for the column to be trusted
+MIN_ORDERED_SHARE = 0.9
+MAX_STATEMENT_AGE = timedelta(days=3 * 365)
+
+_metrics = {"fast_path": 0, "fallback": 0}
+_metrics_lock = threading.Lock()
+
+
+@dataclass
+class DateRange:
+    first: date
+    last: date
+    transactions: int
+
+
+def _year(value):
+    year = int(value)
+    return year + 2000 if year < 100 else year
+
+
+def parse_line_date(line, default_year=None):
+    try:
+        match = ISO_DATE.match(line)
+        if match:
+            return date(int(match[1]), int(match[2]), int(match[3]))
+        match = NUMERIC_DATE.match(line)
+        if match:
+            return date(_year(match[3]), int(match[2]), int(match[1]))
+        match = TEXT_DATE.match(line)
+        if match and match[2].lower() in MONTHS:
+            year = _year(match[3]) if match[3] else default_year
+            if year:
+                return date(year, MONTHS[match[2].lower()], int(match[1]))
+    except ValueError:
+        pass
+    return None
+
+
+def _ordered_share(dates):
+    pairs = list(zip(dates, dates[1:]))
+    if not pairs:
+        return 0.0
+    ascending = sum(1 for a, b in pairs if a <= b)
+    descending = sum(1 for a, b in pairs if a >= b)
+    return max(ascending, descending) / len(pairs)
+
+
+def find_date_range(text, today=None):
+    # Returns a DateRange when the text has a confident transaction-date column, otherwise None
+    today = today or date.today()
+    lines = text.splitlines()
+    if not any(keyword in text.lower() for keyword in STATEMENT_KEYWORDS):
+        return None
+
+    dated = [d for d in (parse_line_date(line) for line in lines) if d]
+    # Lines like "12 Mar" borrow the statement's most common year
+    default_year = Counter(d.year for d in dated).most_common(1)[0][0] if dated else None
+    dates = [d for d in (parse_line_date(line, default_year) for line in lines) if d]
+    dates = [d for d in dates if today - MAX_STATEMENT_AGE <= d <= today]
+
+    if len(dates) < MIN_TRANSACTIONS or _ordered_share(dates) < MIN_ORDERED_SHARE:
+        return None
+    return DateRange(first=min(dates), last=max(dates), transactions=len(dates))
+
+
+def record(fast_path):
+    with _metrics_lock:
+        _metrics["fast_path" if fast_path else "fallback"] += 1
+
+
+def fast_path_metrics():
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    total = metrics["fast_path"] + metrics["fallback"]
+    metrics["hit_rate"] = metrics["fast_path"] / total if total else 0.0
+    return metrics
+
+
+def local_date_range(document):
+    # Fast path for checkbankstatement: reads the same header and date-window pages the model would see
+    date_range = find_date_range("\n".join(select_statement_pages(document).values())) if document.is_pdf else None
+    record(date_range is not None)
+    return date_range
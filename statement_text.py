@@ -0,0 +1,183 @@
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+import fitz
+import tiktoken
+
+# The account holder's name and address sit on the first page
+HEADER_PAGES = 1
+# How far in from each end we look for the first/last page carrying transactions
+SCAN_PAGES = 4
+# Statements at least this long have their candidate pages extracted in a process pool
+PARALLEL_PAGE_THRESHOLD = 20
+PROCESS_WORKERS = 4
+# Seconds to wait on the pool before extracting the remaining pages in-process
+POOL_TIMEOUT = 30
+TOKEN_BUDGET = 6000
+PAYSLIP_TOKEN_BUDGET = 3000
+# Less extractable text than this means a scanned or image-only PDF
+MIN_TEXT_LAYER_CHARS = 200
+# Used instead of tiktoken when its BPE file can't be loaded
+CHARS_PER_TOKEN = 4
+# Deploys vendor the o200k_base file here so tiktoken never downloads it at runtime; see README
+TIKTOKEN_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache")
+# A page with fewer dated lines than this is a cover, summary or legal page
+MIN_DATED_LINES = 2
+
+DATE_PATTERN = re.compile(
+    r"\b(\d{1,2}[/\-.]\d{1,2}[/\-.]\d{2,4}"
+    r"|\d{4}-\d{2}-\d{2}"
+    r"|\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)[a-z]*\.?(?:\s+\d{2,4})?)\b",
+    re.IGNORECASE,
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, not forked: the server process holds PyMuPDF, sqlite and event-loop threads
+            _pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool():
+    # A worker died; the next long statement starts a fresh pool
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def _extract_pages(data, page_numbers):
+    # Runs in a worker process, which opens its own PyMuPDF handle
+    with fitz.open(stream=data, filetype="pdf") as pdf:
+        return [(n, pdf.load_page(n).get_text()) for n in page_numbers]
+
+
+def iter_page_text(document, page_numbers):
+    # Streams page text in the requested order, fanning out to worker processes for long statements
+    page_numbers = list(page_numbers)
+    if document.page_count < PARALLEL_PAGE_THRESHOLD or len(page_numbers) < 2:
+        for n in page_numbers:
+            yield n, document.page_text(n)
+        return
+    data = bytes(document.data)
+    chunks = [page_numbers[i::PROCESS_WORKERS] for i in range(PROCESS_WORKERS)]
+    futures = {}
+    for chunk in chunks:
+        if chunk:
+            future = _get_pool().submit(_extract_pages, data, chunk)
+            futures.update((n, future) for n in chunk)
+    deadline = time.monotonic() + POOL_TIMEOUT
+    texts = {}
+    for n in page_numbers:
+        if n not in texts:
+            try:
+                texts.update(futures[n].result(timeout=max(0.0, deadline - time.monotonic())))
+            except Exception as error:
+                # A slow or broken pool costs a local extraction, never a hung verification worker
+                if isinstance(error, BrokenProcessPool):
+                    _reset_pool()
+                texts[n] = document.page_text(n)
+        yield n, texts[n]
+
+
+def count_dated_lines(text):
+    return sum(1 for line in text.splitlines() if DATE_PATTERN.search(line))
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    # Loaded on first use from TIKTOKEN_CACHE_DIR, else downloaded; None when neither works (e.g. offline)
+    if os.path.isdir(TIKTOKEN_CACHE):
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE)
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def _truncate(text, max_tokens, keep):
+    encoding = get_encoding()
+    if encoding is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        return text[:max_chars] if keep == "head" else text[-max_chars:]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    tokens = tokens[:max_tokens] if keep == "head" else tokens[-max_tokens:]
+    return encoding.decode(tokens)
+
+
+def select_statement_pages(document):
+    # Returns {page_number: text} for the header plus the first and last pages with transactions
+    page_count = document.page_count
+    header = list(range(min(HEADER_PAGES, page_count)))
+    front = list(range(min(SCAN_PAGES, page_count)))
+    back = [n for n in range(page_count - 1, max(page_count - 1 - SCAN_PAGES, -1), -1) if n not in front]
+    # Long statements get every candidate page up front in parallel; short ones are read lazily
+    # and the scans stop at the first page with transactions
+    texts = dict(iter_page_text(document, front + back)) if page_count >= PARALLEL_PAGE_THRESHOLD else {}
+
+    def has_transactions(n):
+        if n not in texts:
+            texts[n] = document.page_text(n)
+        return count_dated_lines(texts[n]) >= MIN_DATED_LINES
+
+    first = next((n for n in front + back[::-1] if has_transactions(n)), None)
+    last = next((n for n in back + front[::-1] if has_transactions(n)), None)
+    selected = set(header) | {n for n in (first, last) if n is not None}
+    return {n: texts[n] if n in texts else document.page_text(n) for n in sorted(selected)}
+
+
+def statement_text(document, token_budget=TOKEN_BUDGET):
+    # Compact text for the BankStatement model: header and date-window pages only, capped at token_budget
+    pages = select_statement_pages(document)
+    numbers = sorted(pages)
+    share = token_budget // len(numbers) if numbers else token_budget
+    parts = []
+    for i, n in enumerate(numbers):
+        # The last transaction sits at the bottom of the final page, everything else is read from the top
+        keep = "tail" if i == len(numbers) - 1 and len(numbers) > 1 else "head"
+        parts.append(_truncate(pages[n], share, keep))
+    return "\n".join(parts)
+
+
+def has_text_layer(document):
+    # Reads pages only until MIN_TEXT_LAYER_CHARS is reached; the answer is memoised on the Document
+    if not document.is_pdf:
+        return False
+    if document.text_layer is None:
+        chars = 0
+        for n in range(document.page_count):
+            chars += len(document.page_text(n).strip())
+            if chars >= MIN_TEXT_LAYER_CHARS:
+                break
+        document.text_layer = chars >= MIN_TEXT_LAYER_CHARS
+    return document.text_layer
+
+
+def payslip_text(document, token_budget=PAYSLIP_TOKEN_BUDGET):
+    # Every page of a digital payslip, in order, each capped at an even share of token_budget
+    texts = [text for _, text in iter_page_text(document, range(document.page_count))]
+    share = token_budget // len(texts)
+    return "\n".join(_truncate(text, share, "head") for text in texts)
@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+
+from langchain_core.utils.json import parse_partial_json
+
+_metrics = {"streamed": 0, "aborted": 0, "full_seconds": 0.0, "abort_seconds": 0.0,
+            "full_output_tokens": 0, "abort_output_tokens": 0}
+_metrics_lock = threading.Lock()
+
+
+def schema_fields(schema):
+    # pydantic v2 models expose model_fields; the langchain_core.pydantic_v1 ones only __fields__
+    return list(getattr(schema, "model_fields", None) or schema.__fields__)
+
+
+class StreamingExtractor:
+    # Drop-in for with_structured_output(schema, include_raw=True) that streams the tool call and
+    # stops as soon as the schema's first field, the verification flag, arrives as false.
+    # Every verifier schema declares that flag first, so the model emits it before any other field.
+
+    def __init__(self, chat_model, schema):
+        self.schema = schema
+        self.fields = schema_fields(schema)
+        self.flag = self.fields[0]
+        self.runnable = chat_model.bind_tools([schema], tool_choice=schema.__name__)
+
+    def _rejected(self):
+        # Remaining fields are blank; the verifiers return -1 on the flag before reading them
+        payload = {name: "" for name in self.fields}
+        payload[self.flag] = False
+        return self.schema(**payload)
+
+    async def ainvoke(self, input):
+        start = time.perf_counter()
+        message = None
+        chunks = 0
+        stream = self.runnable.astream(input, stream_usage=True)
+        try:
+            async for chunk in stream:
+                message = chunk if message is None else message + chunk
+                if not chunk.tool_call_chunks:
+                    continue
+                chunks += 1
+                partial = parse_partial_json(message.tool_call_chunks[0]["args"] or "{}")
+                if isinstance(partial, dict) and partial.get(self.flag) is False:
+                    _record(aborted=True, seconds=time.perf_counter() - start, output_tokens=chunks)
+                    return {"raw": message, "parsed": self._rejected(), "parsing_error": None}
+        finally:
+            await stream.aclose()
+
+        usage = getattr(message, "usage_metadata", None) or {}
+        _record(aborted=False, seconds=time.perf_counter() - start, output_tokens=usage.get("output_tokens", chunks))
+        try:
+            args = json.loads(message.tool_call_chunks[0]["args"])
+            return {"raw": message, "parsed": self.schema(**args), "parsing_error": None}
+        except Exception as error:
+            return {"raw": message, "parsed": None, "parsing_error": error}
+
+
+def _record(aborted, seconds, output_tokens):
+    prefix = "abort" if aborted else "full"
+    with _metrics_lock:
+        _metrics["aborted" if aborted else "streamed"] += 1
+        _metrics[f"{prefix}_seconds"] += seconds
+        _metrics[f"{prefix}_output_tokens"] += output_tokens
+
+
+def streaming_metrics():
+    # Savings are estimated against the average completed extraction
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    full, aborted = metrics["streamed"], metrics["aborted"]
+    avg_full_seconds = metrics["full_seconds"] / full if full else 0.0
+    avg_full_tokens = metrics["full_output_tokens"] / full if full else 0.0
+    metrics["saved_seconds_est"] = max(0.0, aborted * avg_full_seconds - metrics["abort_seconds"])
+    metrics["saved_output_tokens_est"] = max(0.0, aborted * avg_full_tokens - metrics["abort_output_tokens"])
+    return metrics
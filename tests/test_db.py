@@ -0,0 +1,115 @@
+import threading
+
+from psycopg2 import extensions
+from psycopg2 import pool as pg_pool
+
+import re
+
+from db import LIKE_ESCAPE, ConnectionPool, contains_pattern
+
+
+class FakeInfo:
+    transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.info = FakeInfo()
+
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def fake_pool(monkeypatch, **kwargs):
+    opened = []
+
+    def connect(*args, **kw):
+        conn = FakeConnection()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(pg_pool.psycopg2, "connect", connect)
+    return ConnectionPool(**kwargs), opened
+
+
+def check_out_concurrently(pool, count):
+    barrier = threading.Barrier(count)
+    used = []
+    lock = threading.Lock()
+
+    def work():
+        with pool.connection() as conn:
+            with lock:
+                used.append(conn)
+            barrier.wait(timeout=5)
+
+    threads = [threading.Thread(target=work) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return used
+
+
+def test_concurrent_checkouts_reuse_returned_connections(monkeypatch):
+    pool, opened = fake_pool(monkeypatch, minconn=1, maxconn=8)
+    first = check_out_concurrently(pool, 6)
+    second = check_out_concurrently(pool, 6)
+    assert len(opened) == 6
+    assert {id(conn) for conn in second} == {id(conn) for conn in first}
+    assert not any(conn.closed for conn in opened)
+
+
+def test_max_idle_caps_pooled_connections(monkeypatch):
+    pool, opened = fake_pool(monkeypatch, minconn=1, maxconn=8, max_idle=2)
+    check_out_concurrently(pool, 6)
+    assert sum(not conn.closed for conn in opened) == 2
+
+
+def ilike(value, pattern):
+    # PostgreSQL ILIKE ... ESCAPE semantics, enough to check the patterns we build
+    regex, chars = "", iter(pattern)
+    for char in chars:
+        if char == LIKE_ESCAPE:
+            regex += re.escape(next(chars))
+        elif char == "%":
+            regex += ".*"
+        elif char == "_":
+            regex += "."
+        else:
+            regex += re.escape(char)
+    return re.fullmatch(regex, value, re.IGNORECASE | re.DOTALL) is not None
+
+
+def test_contains_pattern_matches_underscore_literally():
+    pattern = contains_pattern("_")
+    assert ilike("jane_doe@example.com", pattern)
+    assert not ilike("jane.doe@example.com", pattern)
+
+
+def test_contains_pattern_escapes_percent_and_escape_character():
+    assert not ilike("anything", contains_pattern("%"))
+    assert ilike("100% done", contains_pattern("0% d"))
+    assert ilike("back\\slash", contains_pattern("k\\s"))
+    assert not ilike("backslash", contains_pattern("k\\s"))
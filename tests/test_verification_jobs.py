@@ -0,0 +1,39 @@
+import threading
+
+from verification_jobs import BACKFILL, DONE, INTERACTIVE, VerificationQueue, get_verification_queue
+
+
+def test_interactive_jobs_run_before_backfill():
+    gate = threading.Event()
+    order = []
+
+    def handler(name):
+        if name == "blocker":
+            gate.wait(timeout=5)
+        order.append(name)
+
+    queue = VerificationQueue(handler, workers=1)
+    queue.submit(name="blocker")
+    jobs = [
+        queue.submit(priority=BACKFILL, name="backfill-1"),
+        queue.submit(priority=INTERACTIVE, name="interactive-1"),
+        queue.submit(priority=BACKFILL, name="backfill-2"),
+        queue.submit(priority=INTERACTIVE, name="interactive-2"),
+    ]
+    gate.set()
+    queue._queue.join()
+    assert all(queue.get(job).status == DONE for job in jobs)
+    assert order == ["blocker", "interactive-1", "interactive-2", "backfill-1", "backfill-2"]
+
+
+def test_changed_handler_gets_its_own_queue():
+    def handler():
+        return 1
+
+    first = get_verification_queue("test-app", handler, workers=1)
+    assert get_verification_queue("test-app", handler, workers=1) is first
+
+    def handler():
+        return 2
+
+    assert get_verification_queue("test-app", handler, workers=1) is not first
@@ -0,0 +1,128 @@
+import base64
+import os
+import threading
+import time
+from collections import deque
+from io import BytesIO
+
+from PIL import Image
+
+from image_preprocess import estimate_image_tokens
+from statement_text import count_tokens
+from verification_jobs import ParkJob
+
+WINDOW_SECONDS = 60
+# Structured outputs are a few fields; OpenAI counts the completion allowance against TPM as well
+OUTPUT_TOKEN_ALLOWANCE = 500
+# Per-message overhead in the chat format
+MESSAGE_OVERHEAD = 4
+# (tokens per minute, requests per minute). Override with e.g. LLM_TPM_GPT_4O / LLM_RPM_GPT_4O
+DEFAULT_LIMITS = {
+    "gpt-4o": (30000, 500),
+    "gpt-4o-mini": (200000, 500),
+}
+FALLBACK_LIMITS = (30000, 500)
+
+
+class BudgetExhausted(ParkJob):
+    # The model's TPM/RPM window can't fit the request before the deadline; retry_after is when it could
+    pass
+
+
+def _env_name(model):
+    return model.upper().replace("-", "_").replace(".", "_")
+
+
+def get_limits(model):
+    tpm, rpm = DEFAULT_LIMITS.get(model, FALLBACK_LIMITS)
+    return (int(os.getenv("LLM_TPM_" + _env_name(model), tpm)),
+            int(os.getenv("LLM_RPM_" + _env_name(model), rpm)))
+
+
+def _image_tokens(url):
+    # Only the JPEG header is parsed to get the raster size
+    data = base64.b64decode(url.split(",", 1)[1])
+    with Image.open(BytesIO(data)) as image:
+        return estimate_image_tokens(*image.size)
+
+
+def estimate_tokens(messages):
+    # Prompt estimate for a structured-output call, before it is sent
+    if isinstance(messages, str):
+        return count_tokens(messages) + MESSAGE_OVERHEAD + OUTPUT_TOKEN_ALLOWANCE
+    total = OUTPUT_TOKEN_ALLOWANCE
+    for message in messages:
+        total += MESSAGE_OVERHEAD
+        content = message.content
+        if isinstance(content, str):
+            total += count_tokens(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                total += count_tokens(part["text"])
+            elif part.get("type") == "image_url":
+                total += _image_tokens(part["image_url"]["url"])
+    return total
+
+
+class TokenBudget:
+    # Sliding one-minute window of admitted requests for one model
+
+    def __init__(self, tpm, rpm):
+        self.tpm = tpm
+        self.rpm = rpm
+        self._entries = deque()
+        self._tokens = 0
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "waited": 0, "wait_seconds": 0.0}
+
+    def _expire(self, now):
+        while self._entries and now - self._entries[0][0] >= WINDOW_SECONDS:
+            _, tokens = self._entries.popleft()
+            self._tokens -= tokens
+
+    def reserve(self, tokens):
+        # Admits the request and returns (0, entry), or returns (seconds until it could fit, None)
+        tokens = min(tokens, self.tpm)
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._entries) < self.rpm and self._tokens + tokens <= self.tpm:
+                entry = [now, tokens]
+                self._entries.append(entry)
+                self._tokens += tokens
+                self._stats["admitted"] += 1
+                return 0.0, entry
+            # Walk the window until enough requests and tokens have aged out
+            freed, count = 0, len(self._entries)
+            for timestamp, entry_tokens in self._entries:
+                freed += entry_tokens
+                count -= 1
+                if count < self.rpm and self._tokens - freed + tokens <= self.tpm:
+                    return timestamp + WINDOW_SECONDS - now, None
+            return WINDOW_SECONDS, None
+
+    def release(self, entry):
+        # For a reserved request that never went out
+        with self._lock:
+            if entry in self._entries:
+                self._entries.remove(entry)
+                self._tokens -= entry[1]
+
+    def settle(self, entry, actual_tokens):
+        # Replace the estimate with what the API actually billed
+        with self._lock:
+            if entry in self._entries:
+                self._tokens += actual_tokens - entry[1]
+                entry[1] = actual_tokens
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self._stats["waited"] += 1
+            self._stats["wait_seconds"] += seconds
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return {**self._stats, "tpm_used": self._tokens, "rpm_used": len(self._entries),
+                    "tpm_limit": self.tpm, "rpm_limit": self.rpm}
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import streamlit as st
+
+CACHE_PATH = "verification_cache.sqlite3"
+# Bump to invalidate every cached extraction, e.g. after changing the model
+CACHE_VERSION = 3
+MAX_ENTRIES = 10000
+TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class VerificationCache:
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS extractions (
+                key TEXT PRIMARY KEY,
+                document_type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS extractions_last_access ON extractions (last_access)")
+        self._conn.commit()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(digest, document_type, schema, prompt):
+        # The prompt text and schema are part of the key, so editing either invalidates old entries
+        schema_json = json.dumps(schema.schema(), sort_keys=True)
+        material = "|".join([str(CACHE_VERSION), digest, document_type, prompt, schema_json])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, created_at FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+                    self._conn.commit()
+                self._stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE extractions SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self._stats["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key, document_type, payload):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, document_type, payload, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, document_type, json.dumps(payload), now, now),
+            )
+            self._conn.execute("DELETE FROM extractions WHERE created_at < ?", (now - self.ttl,))
+            overflow = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                # Least recently used entries go first
+                self._conn.execute(
+                    "DELETE FROM extractions WHERE key IN "
+                    "(SELECT key FROM extractions ORDER BY last_access LIMIT ?)",
+                    (overflow,),
+                )
+                self._stats["evictions"] += overflow
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+@st.cache_resource(show_spinner=False)
+def get_verification_cache():
+    return VerificationCache()
+
+
+def cached_extraction(source, document_type, schema, prompt, extract):
+    # Returns the structured model output for this file, calling extract() only on a cache miss.
+    # source is a path or a document.Document, which already knows its digest.
+    cache = get_verification_cache()
+    digest = source.digest if hasattr(source, "digest") else file_digest(source)
+    key = cache.make_key(digest, document_type, schema, prompt)
+    payload = cache.get(key)
+    if payload is not None:
+        return schema(**payload)
+    response = extract()
+    cache.put(key, document_type, response.dict())
+    return response
@@ -0,0 +1,152 @@
+import hashlib
+import itertools
+import os
+import queue
+import threading
+import time
+import types
+import uuid
+from dataclasses import dataclass, field
+
+import streamlit as st
+
+# Lower number runs first: customers waiting on the upload page beat re-verification backfills
+INTERACTIVE = 0
+BACKFILL = 10
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Waiting out a provider outage; requeued automatically
+PARKED = "parked"
+
+DEFAULT_WORKERS = int(os.getenv("VERIFICATION_WORKERS", "4"))
+MAX_PARKS = 20
+# Argument types a finished job keeps for display; anything else is released when the job ends
+SCALARS = (str, int, float, bool, type(None))
+
+
+class ParkJob(Exception):
+    # Raised by a handler that can't run now but should be retried after retry_after seconds
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class VerificationJob:
+    kwargs: dict
+    priority: int = INTERACTIVE
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    status: str = QUEUED
+    result: object = None
+    error: str = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+    parks: int = 0
+
+
+class VerificationQueue:
+    def __init__(self, handler, workers=DEFAULT_WORKERS, keep_finished=1000):
+        self.handler = handler
+        self._queue = queue.PriorityQueue()
+        self._jobs = {}
+        self._finished = []
+        self._keep_finished = keep_finished
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"verification-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, priority=INTERACTIVE, **kwargs):
+        job = VerificationJob(kwargs=kwargs, priority=priority)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._enqueue(job)
+        return job.id
+
+    def _enqueue(self, job):
+        job.status = QUEUED
+        # The sequence number keeps FIFO order within a priority level
+        self._queue.put((job.priority, next(self._sequence), job))
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            job.status = RUNNING
+            job.started_at = time.time()
+            try:
+                job.result = self.handler(**job.kwargs)
+                job.status = DONE
+            except ParkJob as e:
+                if job.parks < MAX_PARKS:
+                    self._park(job, e)
+                    continue
+                job.error = str(e)
+                job.status = FAILED
+            except Exception as e:
+                job.error = str(e)
+                job.status = FAILED
+            job.finished_at = time.time()
+            # Finished jobs are kept for status lookups only, so drop heavy arguments like the parsed Document
+            job.kwargs = {key: value for key, value in job.kwargs.items() if isinstance(value, SCALARS)}
+            self._forget_old(job)
+            self._queue.task_done()
+
+    def _park(self, job, error):
+        job.parks += 1
+        job.status = PARKED
+        job.error = str(error)
+        timer = threading.Timer(error.retry_after, self._enqueue, args=(job,))
+        timer.daemon = True
+        timer.start()
+        self._queue.task_done()
+
+    def _forget_old(self, job):
+        with self._lock:
+            self._finished.append(job.id)
+            while len(self._finished) > self._keep_finished:
+                self._jobs.pop(self._finished.pop(0), None)
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {status: 0 for status in (QUEUED, RUNNING, PARKED, DONE, FAILED)}
+        for job in jobs:
+            counts[job.status] += 1
+        waits = [job.started_at - job.created_at for job in jobs if job.started_at]
+        counts["workers"] = len(self._workers)
+        counts["avg_wait_s"] = sum(waits) / len(waits) if waits else 0.0
+        return counts
+
+
+def _code_digest(code):
+    # Nested code objects repr with their address, so they are hashed recursively instead
+    digest = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        digest.update(_code_digest(const).encode() if isinstance(const, types.CodeType) else repr(const).encode())
+    return digest.hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def _get_queue(name, handler_key, _handler, workers):
+    return VerificationQueue(_handler, workers)
+
+
+def get_verification_queue(name, handler, workers=DEFAULT_WORKERS):
+    # Every rerun of an app shares one queue and worker pool. The handler object itself can't be hashed,
+    # so its qualified name, bytecode and constants key the queue: editing the handler starts a fresh queue.
+    code = getattr(handler, "__code__", None)
+    handler_key = (f"{handler.__module__}.{handler.__qualname__}", _code_digest(code) if code else None)
+    return _get_queue(name, handler_key, handler, workers)